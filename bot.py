@@ -8,17 +8,27 @@
 # - ACK hàng đợi Telegram TRƯỚC khi xử lý (getUpdates offset=max+1)
 # - Reply an toàn: kèm message_thread_id (nếu có), fallback gửi thường khi 400 Bad Request
 # - Báo cáo 21h dùng HTML (escape + auto split) — mục 1: “Các Kho đã gửi báo cáo”
-
-import os, re, time, datetime, hashlib
+# - --serve: chạy liên tục, long-poll getUpdates, giữ bộ nhớ chống trùng trong RAM
+# - Nhiều nhóm (TELEGRAM_CHAT_IDS): mỗi nhóm một worker song song, lease + key Meta riêng
+# - --webhook: server HTTP nhận update (kiểm secret token), hàng đợi có giới hạn + gộp album theo thời gian
+# - /status [mã]: số nơi đã gửi/thiếu trong ngày, trả lời từ rollup trong RAM (cache ngắn)
+# - Lưu trữ: Airtable (mặc định) hoặc SQLite cục bộ (STORAGE_BACKEND=sqlite); --migrate-to chép giữa hai bên
+
+import os, re, time, datetime, hashlib, json, sqlite3, threading, queue, base64, contextlib, struct, unicodedata, math, itertools
+from urllib.parse import urlsplit, unquote, quote
 from typing import List, Dict, Any, Set
-import pytz
 import requests
 from requests.exceptions import HTTPError
-from pyairtable import Api  # v3.x
+# pyairtable (v3.x) import lazily trong _get_api(): mất ~0.3s, lần chạy không có update không cần tới
 
 # ===== ENV =====
 TELEGRAM_BOT_TOKEN  = os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("BOT_TOKEN")
 TELEGRAM_CHAT_ID    = str(os.getenv("TELEGRAM_CHAT_ID") or os.getenv("GROUP_ID") or "").strip()
+# Nhiều nhóm trong 1 deployment: danh sách chat id cách nhau bởi dấu phẩy (mặc định chỉ TELEGRAM_CHAT_ID)
+TELEGRAM_CHAT_IDS   = [c.strip() for c in (os.getenv("TELEGRAM_CHAT_IDS") or TELEGRAM_CHAT_ID).split(",") if c.strip()]
+# Endpoint API (override để chạy với server giả lập, xem tools/bench.py)
+TELEGRAM_API_BASE   = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+AIRTABLE_ENDPOINT_URL = os.getenv("AIRTABLE_ENDPOINT_URL", "https://api.airtable.com").rstrip("/")
 
 AIRTABLE_TOKEN      = os.getenv("AIRTABLE_TOKEN")
 AIRTABLE_BASE_ID    = os.getenv("AIRTABLE_BASE_ID")
@@ -29,32 +39,473 @@ TBL_IMAGES          = os.getenv("TBL_IMAGES", "").strip()  # optional: bật ch
 # Tên cột Messages (có thể override qua ENV)
 COL_MSG_TEXT        = os.getenv("COL_MSG_TEXT", "TextOrCaption")
 COL_MSG_CODE        = os.getenv("COL_MSG_CODE", "Code")
-COL_MSG_TS          = os.getenv("COL_MSG_TS", "Timestamp")  # chỉ dùng khi đọc
+COL_MSG_TS          = os.getenv("COL_MSG_TS", "Timestamp")  # giờ gửi; chỉ ghi khi replay tin ngày cũ
+COL_MSG_CHAT        = os.getenv("COL_MSG_CHAT", "").strip() # optional: chat id (nhiều nhóm dùng chung 1 base)
 
 # Danh sách nơi bắt buộc (Meta)
 COL_META_CODE       = os.getenv("COL_META_CODE", "MaNoi")
 COL_META_NAME       = os.getenv("COL_META_NAME", "TenNoi")
 COL_META_KEY        = os.getenv("COL_META_KEY", "Key")
 COL_META_VAL        = os.getenv("COL_META_VAL", "Value")
+COL_META_CHAT       = os.getenv("COL_META_CHAT", "").strip() # optional: nơi thuộc nhóm nào (trống = mọi nhóm)
 
 # Bảng IMAGES (nếu dùng)
 COL_IMG_HASH        = os.getenv("COL_IMG_HASH", "FileUniqueId")
 COL_IMG_CODE        = os.getenv("COL_IMG_CODE", "Code")
 COL_IMG_DATE        = os.getenv("COL_IMG_DATE", "Date")
+COL_IMG_PHASH       = os.getenv("COL_IMG_PHASH", "").strip() # optional: dHash (hex) để dựng lại index ảnh gần trùng
+
+# Thư mục cache cục bộ (watermark, index...). Trên GitHub Actions giữ qua các lần chạy bằng actions/cache
+STATE_DIR           = os.getenv("STATE_DIR", ".state")
 
-VN_TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+# Giới hạn ghi Airtable: tối đa 10 record/request, ~5 request/giây/base
+AIRTABLE_BATCH      = 10
+AIRTABLE_RPS        = float(os.getenv("AIRTABLE_RPS", "5"))
+
+VN_TZ = datetime.timezone(datetime.timedelta(hours=7), "Asia/Ho_Chi_Minh")   # VN không có DST
 CODE_RE = re.compile(r"^(\d{8})\s*-\s*", re.UNICODE)
 CODE8_RE = re.compile(r"^\d{8}$")
-SHA1_RE = re.compile(r"^[0-9a-f]{40}$")
+SHA1_RE = re.compile(r"^[0-9a-f]{40}$")   # định dạng cũ của warn_caps_* (sha1 đầy đủ)
+CAP_HASH_HEX = 16                          # hash caption: 64 bit đầu của sha1
+META_CELL_MAX = 9000                       # độ dài tối đa 1 ô Value; dài hơn thì chia sang key.1, key.2...
 
 MSG_OK      = "🆗Đã ghi nhận báo cáo 5s ngày hôm nay"
 MSG_BADFMT  = "🆕Kiểm tra lại format và gửi báo cáo lại"
 MSG_DUPIMG  = "⛔️Ảnh/caption trùng với trước đây, nhờ kiểm tra lại"
 
-# ===== Airtable client (v3) =====
-_api = Api(AIRTABLE_TOKEN)
+# ===== Instrumentation: số lần gọi / bytes / độ trễ / lỗi theo endpoint + thời gian từng phase =====
+METRICS_PROM_FILE   = os.getenv("METRICS_PROM_FILE", "").strip()   # optional: file cho node_exporter textfile
+LATENCY_BUCKETS     = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)    # giây (histogram kiểu Prometheus)
+
+class _Metrics:
+    """Bộ đếm trong process (thread-safe); in tổng kết JSON-lines khi kết thúc một lần chạy."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.endpoints: Dict[str, Dict[str, Any]] = {}
+        self.phases: Dict[str, Dict[str, float]] = {}
+
+    def record(self, endpoint: str, seconds: float, bytes_out: int, bytes_in: int, error: bool):
+        with self.lock:
+            e = self.endpoints.get(endpoint)
+            if e is None:
+                e = self.endpoints[endpoint] = {"count": 0, "errors": 0, "bytes_out": 0, "bytes_in": 0,
+                                                "seconds": 0.0, "max": 0.0,
+                                                "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+            e["count"] += 1
+            e["errors"] += int(error)
+            e["bytes_out"] += bytes_out
+            e["bytes_in"] += bytes_in
+            e["seconds"] += seconds
+            e["max"] = max(e["max"], seconds)
+            i = 0
+            while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+                i += 1
+            e["buckets"][i] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Cộng dồn thời gian của một phase (các thread chạy song song thì cộng dồn cả)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self.lock:
+                p = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                p["count"] += 1
+                p["seconds"] += dt
+
+    def summary(self, run: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            lines: List[Dict[str, Any]] = [{"type": "run", "run": run,
+                                            "seconds": round(time.monotonic() - self.started, 3)}]
+            for name, e in sorted(self.endpoints.items()):
+                lines.append({"type": "endpoint", "endpoint": name, "count": e["count"], "errors": e["errors"],
+                              "bytes_out": e["bytes_out"], "bytes_in": e["bytes_in"],
+                              "seconds": round(e["seconds"], 3), "max": round(e["max"], 3),
+                              "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], e["buckets"]))})
+            for name, p in sorted(self.phases.items()):
+                lines.append({"type": "phase", "phase": name, "count": p["count"], "seconds": round(p["seconds"], 3)})
+        return lines
+
+    def emit(self, run: str, prom_file: str = METRICS_PROM_FILE):
+        lines = self.summary(run)
+        for line in lines:
+            print(json.dumps(line, ensure_ascii=False))
+        if prom_file:
+            self.write_prom(prom_file, run)
+
+    def write_prom(self, path: str, run: str):
+        """Ghi file text exposition format (ghi file tạm rồi rename để collector không đọc dở)."""
+        def lbl(**kw):
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                                  for k, v in kw.items()) + "}"
+        out = ["# TYPE bot_api_requests_total counter", "# TYPE bot_api_errors_total counter",
+               "# TYPE bot_api_bytes_total counter", "# TYPE bot_api_latency_seconds histogram",
+               "# TYPE bot_phase_seconds gauge", "# TYPE bot_run_seconds gauge",
+               "# TYPE bot_last_run_timestamp_seconds gauge"]
+        with self.lock:
+            for name, e in sorted(self.endpoints.items()):
+                out.append(f"bot_api_requests_total{lbl(run=run, endpoint=name)} {e['count']}")
+                out.append(f"bot_api_errors_total{lbl(run=run, endpoint=name)} {e['errors']}")
+                out.append(f"bot_api_bytes_total{lbl(run=run, endpoint=name, direction='out')} {e['bytes_out']}")
+                out.append(f"bot_api_bytes_total{lbl(run=run, endpoint=name, direction='in')} {e['bytes_in']}")
+                cum = 0
+                for le, n in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], e["buckets"]):
+                    cum += n
+                    out.append(f"bot_api_latency_seconds_bucket{lbl(run=run, endpoint=name, le=le)} {cum}")
+                out.append(f"bot_api_latency_seconds_sum{lbl(run=run, endpoint=name)} {e['seconds']:.6f}")
+                out.append(f"bot_api_latency_seconds_count{lbl(run=run, endpoint=name)} {e['count']}")
+            for name, p in sorted(self.phases.items()):
+                out.append(f"bot_phase_seconds{lbl(run=run, phase=name)} {p['seconds']:.6f}")
+            out.append(f"bot_run_seconds{lbl(run=run)} {time.monotonic() - self.started:.3f}")
+            out.append(f"bot_last_run_timestamp_seconds{lbl(run=run)} {int(time.time())}")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(out) + "\n")
+        os.replace(tmp, path)
+
+_metrics = _Metrics()
+
+def _endpoint_name(method: str, url: str) -> str:
+    """'telegram sendMessage' / 'airtable GET Meta' / 'airtable POST Messages'..."""
+    parts = [unquote(p) for p in urlsplit(url).path.split("/") if p]
+    if parts and parts[0] == "file":
+        return "telegram file"
+    if parts and parts[0].startswith("bot"):
+        return f"telegram {parts[-1] if len(parts) > 1 else ''}"
+    if len(parts) >= 3 and parts[0] == "v0":
+        return f"airtable {'GET' if parts[-1] == 'listRecords' else method} {parts[2]}"
+    return f"{method} {urlsplit(url).netloc}"
+
+def _instrument_session(session: requests.Session):
+    """Bọc adapter.send của session: mỗi request thật (kể cả lần retry) được ghi vào _metrics."""
+    for prefix in ("https://", "http://"):
+        adapter = session.get_adapter(prefix + "x")
+        if getattr(adapter, "_metered", False):
+            continue
+        orig = adapter.send
+
+        def send(request, *args, _orig=orig, **kwargs):
+            name = _endpoint_name(request.method, request.url)
+            body = request.body or b""
+            bytes_out = len(body.encode("utf-8") if isinstance(body, str) else body)
+            t0 = time.perf_counter()
+            try:
+                r = _orig(request, *args, **kwargs)
+            except Exception:
+                _metrics.record(name, time.perf_counter() - t0, bytes_out, 0, True)
+                raise
+            if kwargs.get("stream"):
+                bytes_in = int(r.headers.get("Content-Length") or 0)
+            else:
+                bytes_in = len(r.content)
+            _metrics.record(name, time.perf_counter() - t0, bytes_out, bytes_in, r.status_code >= 400)
+            return r
+
+        adapter.send = send
+        adapter._metered = True
+
+# ===== Airtable client (v3) — tạo khi cần lần đầu =====
+_api = None
+_api_lock = threading.Lock()
+
+def _get_api():
+    global _api
+    with _api_lock:
+        if _api is None:
+            from pyairtable import Api
+            _api = Api(AIRTABLE_TOKEN, endpoint_url=AIRTABLE_ENDPOINT_URL)
+            # 1 connection pool cho mọi thread (worker nhóm + nạp song song bước 4), giữ retry của pyairtable
+            retries = _api.session.get_adapter("https://").max_retries
+            adapter = requests.adapters.HTTPAdapter(
+                max_retries=retries, pool_maxsize=max(10, PREFETCH_WORKERS * len(TELEGRAM_CHAT_IDS or [""])))
+            _api.session.mount("https://", adapter)
+            _api.session.mount("http://", adapter)
+            _instrument_session(_api.session)
+    return _api
+
 def _air_table(name: str):
-    return _api.table(AIRTABLE_BASE_ID, name)
+    return _get_api().table(AIRTABLE_BASE_ID, name)
+
+# ===== Storage backend: Airtable (mặc định) hoặc SQLite cục bộ =====
+# Mọi đọc/ghi Messages, Images, Meta (KV, lock, danh sách nơi) đi qua _table(name).
+# Bộ lọc truyền dạng có cấu trúc (created_from/created_before/key), mỗi backend tự dịch;
+# record trả về luôn theo dạng Airtable {"id", "createdTime", "fields"}.
+STORAGE_BACKEND     = os.getenv("STORAGE_BACKEND", "airtable").strip().lower()   # airtable | sqlite
+SQLITE_PATH         = os.getenv("SQLITE_PATH", "bot.sqlite")   # dữ liệu chính (không phải cache STATE_DIR)
+STORAGE_BACKENDS    = ("airtable", "sqlite")
+
+def _prefix_formula(field: str, prefix: str) -> str:
+    return f"LEFT(LOWER(TO_TEXT({{{field}}})), {len(prefix)})='{prefix.lower()}'"
+
+class _AirtableTable:
+    """Bọc pyairtable Table: dịch bộ lọc sang filterByFormula, ghi theo lô giãn cách AIRTABLE_RPS."""
+
+    batch_size = AIRTABLE_BATCH
+
+    def __init__(self, name: str):
+        self.name = name
+        self.tbl = _air_table(name)
+
+    def all(self, fields: "List[str] | None" = None, created_from: str = "", created_before: str = "",
+            key: "tuple | None" = None, key_prefix: "tuple | None" = None,
+            not_key_prefix: "tuple | None" = None) -> List[Dict[str, Any]]:
+        conds = []
+        if created_from:
+            conds.append(f"NOT(IS_BEFORE(CREATED_TIME(), DATETIME_PARSE('{created_from}')))")
+        if created_before:
+            conds.append(f"IS_BEFORE(CREATED_TIME(), DATETIME_PARSE('{created_before}'))")
+        if key:
+            kf, k = key
+            conds.append(f"LOWER(TO_TEXT({{{kf}}}))='{k.lower()}'")
+        for pre, neg in ((key_prefix, False), (not_key_prefix, True)):
+            if pre:
+                c = _prefix_formula(*pre)
+                conds.append(f"NOT({c})" if neg else c)
+        formula = conds[0] if len(conds) == 1 else (f"AND({', '.join(conds)})" if conds else None)
+        kw = {"fields": fields} if fields else {}
+        return self.tbl.all(formula=formula, **kw)
+
+    def create(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return self.tbl.create(fields)
+
+    def batch_create(self, fields_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        _airtable_pacer.wait()
+        return self.tbl.batch_create(fields_list)
+
+    def batch_update(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        _airtable_pacer.wait()
+        return self.tbl.batch_update(records)
+
+    def batch_delete(self, ids: List[str]):
+        _airtable_pacer.wait()
+        return self.tbl.batch_delete(ids)
+
+class _SqliteStore:
+    """Một file SQLite chứa mọi bảng: records(id, tbl, created, fields JSON) + cột trích ra để index.
+
+    Các truy vấn đều chạy trên index: created (lọc theo ngày/watermark), key (COL_META_KEY viết
+    thường — key/key_prefix của Meta), uid (COL_IMG_HASH — tra UID ảnh đã dùng, xem _ImageIndex).
+    createdTime lưu cùng định dạng Airtable nên watermark, cache STATE_DIR và --compact dùng như
+    với Airtable."""
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, tbl TEXT NOT NULL, "
+                        "created TEXT NOT NULL, fields TEXT NOT NULL, key TEXT, uid TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS records_created ON records(tbl, created)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS records_key ON records(tbl, key)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS records_uid ON records(tbl, uid)")
+        self.db.commit()
+
+    @staticmethod
+    def _columns(fields: Dict[str, Any]) -> tuple:
+        key = str(fields.get(COL_META_KEY, "") or "").strip().lower()
+        return key or None, fields.get(COL_IMG_HASH) or None
+
+    def has_uid(self, table: str, uid: str) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM records WHERE tbl=? AND uid=? LIMIT 1",
+                                   (table, uid)).fetchone() is not None
+
+    def count(self, table: str) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM records WHERE tbl=?", (table,)).fetchone()[0]
+
+    def insert(self, table: str, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Ghi record giữ nguyên id/createdTime (migrate); id đã có thì bỏ qua."""
+        rows = [(r["id"], table, r["createdTime"], json.dumps(r.get("fields") or {}, ensure_ascii=False),
+                 *self._columns(r.get("fields") or {})) for r in records]
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+        return records
+
+    def table(self, name: str) -> "_SqliteTable":
+        return _SqliteTable(self, name)
+
+class _SqliteTable:
+    batch_size = 500   # không có giới hạn request -> lô lớn, 1 transaction/lô
+
+    def __init__(self, store: _SqliteStore, name: str):
+        self.store, self.name = store, name
+
+    def all(self, fields: "List[str] | None" = None, created_from: str = "", created_before: str = "",
+            key: "tuple | None" = None, key_prefix: "tuple | None" = None,
+            not_key_prefix: "tuple | None" = None) -> List[Dict[str, Any]]:
+        sql, args = "SELECT id, created, fields FROM records WHERE tbl=?", [self.name]
+        if created_from:
+            sql, args = sql + " AND created >= ?", args + [created_from]
+        if created_before:
+            sql, args = sql + " AND created < ?", args + [created_before]
+        # Bộ lọc key chỉ áp cho COL_META_KEY (cột key đã viết thường); prefix dịch thành khoảng
+        # [p, p + U+10FFFF) để dùng index
+        for flt in (key, key_prefix, not_key_prefix):
+            if flt and flt[0] != COL_META_KEY:
+                raise ValueError(f"{self.name}: key filters only support {COL_META_KEY!r}, got {flt[0]!r}")
+        if key:
+            sql, args = sql + " AND key = ?", args + [key[1].strip().lower()]
+        if key_prefix:
+            p = key_prefix[1].lower()
+            sql, args = sql + " AND key >= ? AND key < ?", args + [p, p + "\U0010ffff"]
+        if not_key_prefix:
+            p = not_key_prefix[1].lower()
+            sql, args = sql + " AND (key IS NULL OR key < ? OR key >= ?)", args + [p, p + "\U0010ffff"]
+        with self.store.lock:
+            rows = self.store.db.execute(sql + " ORDER BY created, id", args).fetchall()
+        out = []
+        for rid, created, raw in rows:
+            f = json.loads(raw)
+            if fields:
+                f = {k: v for k, v in f.items() if k in fields}
+            out.append({"id": rid, "createdTime": created, "fields": f})
+        return out
+
+    def create(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return self.batch_create([fields])[0]
+
+    def batch_create(self, fields_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        now = _airtable_ts(datetime.datetime.now(datetime.timezone.utc))
+        recs = [{"id": "rec" + os.urandom(7).hex(), "createdTime": now, "fields": dict(f)} for f in fields_list]
+        return self.store.insert(self.name, recs)
+
+    def batch_update(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        out = []
+        with self.store.lock:
+            for r in records:
+                row = self.store.db.execute("SELECT created, fields FROM records WHERE tbl=? AND id=?",
+                                            (self.name, r["id"])).fetchone()
+                if row is None:
+                    self.store.db.rollback()
+                    raise KeyError(f"{self.name}: record {r['id']} not found")
+                f = {**json.loads(row[1]), **(r.get("fields") or {})}
+                self.store.db.execute("UPDATE records SET fields=?, key=?, uid=? WHERE id=?",
+                                      (json.dumps(f, ensure_ascii=False), *_SqliteStore._columns(f), r["id"]))
+                out.append({"id": r["id"], "createdTime": row[0], "fields": f})
+            self.store.db.commit()
+        return out
+
+    def batch_delete(self, ids: List[str]):
+        with self.store.lock:
+            self.store.db.executemany("DELETE FROM records WHERE tbl=? AND id=?", [(self.name, i) for i in ids])
+            self.store.db.commit()
+        return [{"id": i, "deleted": True} for i in ids]
+
+_sqlite_store: "_SqliteStore | None" = None
+
+def _get_sqlite_store() -> _SqliteStore:
+    global _sqlite_store
+    with _api_lock:
+        if _sqlite_store is None:
+            _sqlite_store = _SqliteStore(SQLITE_PATH)
+    return _sqlite_store
+
+def _table(name: str, backend: str = ""):
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return _get_sqlite_store().table(name)
+    if backend == "airtable":
+        return _AirtableTable(name)
+    raise SystemExit(f"unknown STORAGE_BACKEND {backend!r} (expected one of {', '.join(STORAGE_BACKENDS)})")
+
+# Lỗi ghi/đọc của 1 record/lô (HTTP/timeout/mất kết nối với Airtable, không tìm thấy record với SQLite)
+_STORE_ERRORS = (requests.exceptions.RequestException, KeyError, sqlite3.Error)
+
+# ===== Ghi Airtable theo lô =====
+class _Pacer:
+    """Giãn cách các request để không vượt quá `rate` request/giây (dùng chung giữa các thread).
+
+    burst > 1 cho phép dồn tối đa `burst` request liền nhau sau khi rảnh (GCRA / token bucket)."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.burst = max(1, burst)
+        self.tat = 0.0   # theoretical arrival time của request kế tiếp
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            tat = max(self.tat, now)
+            delay = tat - (self.burst - 1) * self.interval - now
+            if delay > 0:
+                time.sleep(delay)
+            self.tat = tat + self.interval
+
+_airtable_pacer = _Pacer(AIRTABLE_RPS)
+
+def _chunks(seq, n: int):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+class _WriteBuffer:
+    """Gom các create/update trong một lần chạy rồi flush bằng batch_create/batch_update.
+
+    Mỗi lô tối đa batch_size record của backend (Airtable: AIRTABLE_BATCH, giãn cách theo AIRTABLE_RPS). Nếu cả lô bị từ chối
+    thì ghi lại từng record để tách đúng record lỗi; các lỗi được trả về từ flush().
+    on_done(record | None) của create được gọi sau khi ghi xong (None nếu lỗi)."""
+
+    def __init__(self):
+        self.creates: Dict[str, List[tuple]] = {}                   # table -> [(fields, on_done)]
+        self.updates: Dict[str, Dict[str, Dict[str, Any]]] = {}   # table -> {record_id: fields}
+        self.failures: List[Dict[str, Any]] = []
+
+    def create(self, table: str, fields: Dict[str, Any], on_done=None):
+        self.creates.setdefault(table, []).append((fields, on_done))
+
+    def update(self, table: str, record_id: str, fields: Dict[str, Any]):
+        # Nhiều update cho cùng một record trong lần chạy được gộp lại
+        self.updates.setdefault(table, {}).setdefault(record_id, {}).update(fields)
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self.creates.values()) + sum(len(v) for v in self.updates.values())
+
+    def _fail(self, op: str, table: str, rec: Dict[str, Any], err: Exception):
+        self.failures.append({"op": op, "table": table, "record": rec, "error": str(err)})
+        print(f"[airtable] {op} {table} failed: {json.dumps(rec, ensure_ascii=False)} | {err}")
+
+    def _send(self, op: str, table: str, chunk: List[tuple]):
+        tbl = _table(table)
+        call = tbl.batch_create if op == "create" else tbl.batch_update
+        try:
+            done = call([rec for rec, _ in chunk])
+        except _STORE_ERRORS as e:
+            if len(chunk) == 1:
+                rec, on_done = chunk[0]
+                self._fail(op, table, rec, e)
+                if on_done:
+                    on_done(None)
+                return
+            # Tách lô lỗi thành từng record để biết chính xác record nào hỏng
+            for item in chunk:
+                self._send(op, table, [item])
+            return
+        for (_, on_done), rec in zip(chunk, done):
+            if on_done:
+                on_done(rec)
+
+    def flush(self) -> List[Dict[str, Any]]:
+        start = len(self.failures)
+        # on_done có thể xếp thêm việc ghi mới -> lặp tới khi bộ đệm rỗng
+        while self.creates or self.updates:
+            creates, updates = self.creates, self.updates
+            self.creates, self.updates = {}, {}
+            for table, items in creates.items():
+                for chunk in _chunks(items, _table(table).batch_size):
+                    self._send("create", table, chunk)
+            for table, recs in updates.items():
+                items = [({"id": rid, "fields": f}, None) for rid, f in recs.items()]
+                for chunk in _chunks(items, _table(table).batch_size):
+                    self._send("update", table, chunk)
+        return self.failures[start:]
 
 # ===== Helpers =====
 def _today_vn():
@@ -68,21 +519,137 @@ def _iso_local(dttm):
             return None
     return dttm
 
-def _tg(method: str, **kwargs):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
-    r = requests.post(url, json=kwargs, timeout=30)
+def _day_key(day) -> str:
+    return day.strftime("%Y%m%d")
+
+def _airtable_ts(dttm) -> str:
+    """datetime -> chuỗi UTC đúng định dạng createdTime của Airtable (so sánh được theo thứ tự chuỗi)."""
+    u = dttm.astimezone(datetime.timezone.utc)
+    return u.strftime("%Y-%m-%dT%H:%M:%S.") + f"{u.microsecond // 1000:03d}Z"
+
+def _vn_day_bounds_utc(day):
+    """[start, end) của một ngày giờ VN, quy ra UTC."""
+    start = datetime.datetime.combine(day, datetime.time.min, tzinfo=VN_TZ)
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min, tzinfo=VN_TZ)
+    return _airtable_ts(start), _airtable_ts(end)
+
+# ---- Local state (cache giữa các lần chạy) ----
+def _state_path(name: str) -> str:
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return os.path.join(STATE_DIR, name)
+
+def _load_json_state(name: str, default=None):
+    try:
+        with open(_state_path(name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def _save_json_state(name: str, obj):
+    path = _state_path(name)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def _prune_state(prefix: str, keep: Set[str]):
+    """Xoá các file cache <prefix>* không còn dùng (giữ các tên trong keep)."""
     try:
+        names = os.listdir(STATE_DIR)
+    except OSError:
+        return
+    for n in names:
+        if n.startswith(prefix) and n not in keep:
+            try:
+                os.remove(os.path.join(STATE_DIR, n))
+            except OSError:
+                pass
+
+# ---- Telegram client: 1 Session keep-alive dùng chung, retry + backoff, tôn trọng retry_after ----
+class _TgClient:
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    READ_ONLY = ("getUpdates", "getFile", "getMe", "getChat")   # an toàn để gửi lại khi timeout đọc
+    TIMEOUTS = {"sendMessage": 20, "getFile": 20}                  # giây; getUpdates = long-poll + 10
+
+    def __init__(self, token: str, max_retries: int = 4, backoff: float = 1.0, max_delay: float = 60.0):
+        self.base = f"{TELEGRAM_API_BASE}/bot{token}"
+        self.file_base = f"{TELEGRAM_API_BASE}/file/bot{token}"
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        _instrument_session(self.session)
+
+    def _timeout(self, method: str, kwargs) -> float:
+        if method == "getUpdates":
+            return int(kwargs.get("timeout") or 0) + 10
+        return self.TIMEOUTS.get(method, 30)
+
+    def _delay(self, attempt: int, r=None) -> float:
+        if r is not None:
+            try:
+                ra = (r.json().get("parameters") or {}).get("retry_after")
+            except Exception:
+                ra = None
+            if ra:
+                return min(float(ra), self.max_delay)
+        return min(self.backoff * (2 ** attempt), self.max_delay)
+
+    def call(self, method: str, **kwargs):
+        url = f"{self.base}/{method}"
+        attempt = 0
+        while True:
+            try:
+                r = self.session.post(url, json=kwargs, timeout=self._timeout(method, kwargs))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # ReadTimeout với method ghi (sendMessage...) có thể đã tới Telegram -> không gửi lại
+                retriable = not isinstance(e, requests.exceptions.ReadTimeout) or method in self.READ_ONLY
+                if not retriable or attempt >= self.max_retries:
+                    raise
+                delay = self._delay(attempt)
+            else:
+                if r.status_code not in self.RETRY_STATUS or attempt >= self.max_retries:
+                    return self._result(r)
+                delay = self._delay(attempt, r)
+            attempt += 1
+            print(f"[telegram] {method} retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def download(self, file_path: str) -> bytes:
+        """Tải file đã getFile (URL /file/bot<token>/<file_path>)."""
+        r = self.session.get(self.file_base + "/" + file_path, timeout=self.TIMEOUTS["getFile"])
         r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        # Hiển thị thông tin lỗi từ Telegram để dễ debug
+        return r.content
+
+    @staticmethod
+    def _result(r):
         try:
-            detail = r.json()
-        except Exception:
-            detail = r.text
-        raise requests.exceptions.HTTPError(
-            f"{e} | Telegram said: {detail}"
-        ) from e
-    return r.json()
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            # Hiển thị thông tin lỗi từ Telegram để dễ debug (giữ response để caller đọc status_code)
+            try:
+                detail = r.json()
+            except Exception:
+                detail = r.text
+            raise requests.exceptions.HTTPError(
+                f"{e} | Telegram said: {detail}", response=r
+            ) from e
+        return r.json()
+
+_tg_client: "_TgClient | None" = None
+
+def _tg(method: str, **kwargs):
+    global _tg_client
+    if _tg_client is None:
+        _tg_client = _TgClient(TELEGRAM_BOT_TOKEN, max_retries=int(os.getenv("TG_MAX_RETRIES", "4")))
+    return _tg_client.call(method, **kwargs)
+
+def _tg_file(file_id: str) -> bytes:
+    path = _tg("getFile", file_id=file_id)["result"]["file_path"]
+    return _tg_client.download(path)
 
 def _send_reply(chat_id: str, reply_to_message_id: int, text: str, thread_id: int | None = None):
     payload = {
@@ -110,6 +677,78 @@ def _send_reply(chat_id: str, reply_to_message_id: int, text: str, thread_id: in
 def _send_markdown(chat_id: str, text: str):
     return _tg("sendMessage", chat_id=chat_id, text=text, parse_mode="Markdown")
 
+# ---- Reply gửi nền: hàng đợi + worker thread, giãn cách theo từng nhóm ----
+REPLY_WORKERS        = int(os.getenv("REPLY_WORKERS", "2"))
+REPLY_PER_CHAT_MIN   = float(os.getenv("REPLY_PER_CHAT_MIN", "20"))   # Telegram: ~20 tin/phút/nhóm
+REPLY_DRAIN_SEC      = int(os.getenv("REPLY_DRAIN_SEC", "150"))        # chờ gửi nốt khi kết thúc lần chạy
+
+class _ReplyDispatcher:
+    """Đưa reply (MSG_OK / MSG_BADFMT / MSG_DUPIMG) vào hàng đợi, worker thread gửi dần.
+
+    Collector không phải chờ Telegram giữa các lần ghi Airtable; close() chờ hàng đợi
+    cạn trong giới hạn thời gian, phần còn lại bị bỏ và được báo số lượng."""
+
+    def __init__(self, workers: int = REPLY_WORKERS, per_chat_min: float = REPLY_PER_CHAT_MIN):
+        self.q: "queue.Queue" = queue.Queue()
+        self.per_chat_min = per_chat_min
+        self.pacers: Dict[str, _Pacer] = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.threads = [threading.Thread(target=self._run, name=f"reply-{i}", daemon=True)
+                        for i in range(max(1, workers))]
+        for t in self.threads:
+            t.start()
+
+    def put(self, chat_id: str, reply_to_message_id: int, text: str, thread_id: int | None = None):
+        self.q.put((chat_id, reply_to_message_id, text, thread_id))
+
+    def _pacer(self, chat_id: str) -> _Pacer:
+        with self.lock:
+            p = self.pacers.get(chat_id)
+            if p is None:
+                # Giãn đều, không cho dồn: dồn `burst` tin rồi mới giãn thì phút đầu gửi ~2x giới hạn
+                # của Telegram và phải chờ 429 (chặn worker reply của mọi nhóm)
+                p = self.pacers[chat_id] = _Pacer(self.per_chat_min / 60.0)
+            return p
+
+    def _run(self):
+        while True:
+            item = self.q.get()
+            try:
+                if item is None:
+                    return
+                chat_id, reply_to, text, thread_id = item
+                self._pacer(chat_id).wait()
+                _send_reply(chat_id, reply_to, text, thread_id=thread_id)
+                with self.lock:
+                    self.sent += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                print(f"[reply] send failed: {e}")
+            finally:
+                self.q.task_done()
+
+    def close(self, timeout: float = REPLY_DRAIN_SEC) -> int:
+        """Chờ gửi hết (tối đa timeout giây) rồi dừng worker; trả về số reply bị bỏ."""
+        for _ in self.threads:
+            self.q.put(None)
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        dropped = 0
+        while True:
+            try:
+                item = self.q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                dropped += 1
+        if dropped:
+            print(f"[reply] dropped {dropped} pending reply(ies) after {timeout}s")
+        return dropped
+
 # ---- HTML helpers ----
 def _html_escape(s: str) -> str:
     if s is None:
@@ -133,112 +772,356 @@ def _send_long_html(chat_id: str, html: str, limit: int = 3900):
     if text:
         _send_html(chat_id, text)
 
-# ===== Meta KV with fallback =====
-def _kv_find(tbl, key_field: str, val_field: str, key: str):
-    formula = f"LOWER(TO_TEXT({{{key_field}}}))='{key.lower()}'"
-    return tbl.all(formula=formula), val_field
+# ===== Meta KV with fallback (snapshot 1 lần / lần chạy) =====
+class _MetaStore:
+    """Toàn bộ bảng Meta đọc 1 lần vào dict; get() đọc từ snapshot, set() ghi theo lô.
 
-def _meta_get(key: str) -> str:
-    tbl = _air_table(TBL_META)
-    try:
-        recs, valf = _kv_find(tbl, COL_META_KEY, COL_META_VAL, key)
-        if recs:
-            return str(recs[0]["fields"].get(valf, ""))
-    except HTTPError:
-        pass
-    try:
-        recs, valf = _kv_find(tbl, COL_META_CODE, COL_META_NAME, key)
-        if recs:
-            return str(recs[0]["fields"].get(valf, ""))
-    except HTTPError:
-        pass
-    return ""
+    Key so khớp không phân biệt hoa thường, ưu tiên cặp cột Key/Value rồi mới tới MaNoi/TenNoi
+    (giống truy vấn LOWER(TO_TEXT(...)) cũ). Key chưa có record sẽ được tạo mới (batch create);
+    các set() liên tiếp vào cùng key chưa kịp tạo được gộp vào một record."""
 
-def _meta_set(key: str, val: str):
-    tbl = _air_table(TBL_META)
-    try:
-        recs, valf = _kv_find(tbl, COL_META_KEY, COL_META_VAL, key)
-        if recs:
-            tbl.update(recs[0]["id"], {valf: val}); return
-    except HTTPError:
-        recs = []
-    try:
-        recs, valf = _kv_find(tbl, COL_META_CODE, COL_META_NAME, key)
-        if recs:
-            tbl.update(recs[0]["id"], {valf: val}); return
-    except HTTPError:
-        recs = []
-    for kf, vf in [(COL_META_KEY, COL_META_VAL), (COL_META_CODE, COL_META_NAME)]:
+    PAIRS = [(COL_META_KEY, COL_META_VAL), (COL_META_CODE, COL_META_NAME)]
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records: List[Dict[str, Any]] = []
+        self.loc: Dict[str, tuple] = {}               # key.lower() -> (record_id, value field)
+        self.values: Dict[str, str] = {}              # key.lower() -> value
+        self.pending: Dict[str, Dict[str, Any]] = {}  # key.lower() -> fields đang chờ create
+        self.create_pair = self.PAIRS[0]
+        self.load()
+
+    def load(self):
+        # Các phần của Bloom filter lịch sử (lớn, ít đổi) không nằm trong snapshot; chỉ tải khi cần
         try:
-            tbl.create({kf: key, vf: val}); return
+            recs = _table(TBL_META).all(not_key_prefix=(COL_META_KEY, BLOOM_META_KEY + ":"))
         except HTTPError:
-            continue
-    return
+            recs = _table(TBL_META).all()   # bảng không có cột Key
+        with self.lock:
+            self.records = recs
+            self.loc, self.values = {}, {}
+            for kf, vf in self.PAIRS:
+                for r in recs:
+                    f = r.get("fields", {}) or {}
+                    k = str(f.get(kf, "") or "").strip().lower()
+                    if k and k not in self.loc:
+                        self.loc[k] = (r["id"], vf)
+                        self.values[k] = str(f.get(vf, "") or "")
+
+    def get(self, key: str) -> str:
+        with self.lock:
+            return self.values.get(key.lower(), "")
+
+    def refresh(self, key: str) -> str:
+        """Đọc lại riêng một key từ storage (dùng khi chờ lease do lần chạy khác giữ)."""
+        tbl = _table(TBL_META)
+        k = key.lower()
+        for kf, vf in self.PAIRS:
+            try:
+                recs = tbl.all(key=(kf, k))
+            except HTTPError:
+                continue
+            if recs:
+                with self.lock:
+                    self.loc[k] = (recs[0]["id"], vf)
+                    self.values[k] = str(recs[0]["fields"].get(vf, "") or "")
+                break
+        return self.get(key)
+
+    def set(self, key: str, val: str, buf: "_WriteBuffer | None" = None):
+        """Ghi key=val; buf=None thì flush ngay (1 request), ngược lại chờ buf.flush()."""
+        own = buf is None
+        buf = _WriteBuffer() if own else buf
+        k = key.lower()
+        with self.lock:
+            self.values[k] = val
+            if k in self.loc:
+                rid, vf = self.loc[k]
+                buf.update(TBL_META, rid, {vf: val})
+            elif k in self.pending:
+                kf, vf = self.create_pair
+                self.pending[k][vf] = val
+            else:
+                kf, vf = self.create_pair
+                fields = self.pending[k] = {kf: key, vf: val}
+                buf.create(TBL_META, fields, on_done=lambda rec, k=k, buf=buf: self._created(k, rec, buf))
+        if own:
+            buf.flush()
+
+    def _created(self, k: str, rec, buf: "_WriteBuffer"):
+        with self.lock:
+            fields = self.pending.pop(k, None)
+            if rec is not None:
+                self.loc[k] = (rec["id"], self.create_pair[1])
+                return
+            if fields is None or self.create_pair == self.PAIRS[1]:
+                return
+            # Bảng không có cột Key/Value -> ghi vào cặp MaNoi/TenNoi
+            self.create_pair = self.PAIRS[1]
+            key, val = fields.get(self.PAIRS[0][0], k), fields.get(self.PAIRS[0][1], "")
+        self.set(key, val, buf)
+
+    def delete(self, keys: List[str]) -> int:
+        """Xoá hẳn record của các key (không chỉ để trống giá trị); trả về số record đã xoá."""
+        with self.lock:
+            ids = []
+            for key in keys:
+                k = key.lower()
+                self.values.pop(k, None)
+                loc = self.loc.pop(k, None)
+                if loc:
+                    ids.append(loc[0])
+            drop = set(ids)
+            self.records = [r for r in self.records if r["id"] not in drop]
+        tbl = _table(TBL_META)
+        for chunk in _chunks(ids, tbl.batch_size):
+            tbl.batch_delete(chunk)
+        return len(ids)
+
+    def keys(self) -> List[str]:
+        with self.lock:
+            return list(self.values)
+
+    def master_codes(self, chat_id: str | None = None):
+        codes, name_map = [], {}
+        with self.lock:
+            recs = list(self.records)
+        for r in recs:
+            f = r.get("fields", {})
+            code = str(f.get(COL_META_CODE, "")).strip()
+            if COL_META_CHAT and chat_id:
+                owner = str(f.get(COL_META_CHAT, "") or "").strip()
+                if owner and owner != str(chat_id):
+                    continue
+            if code and CODE8_RE.fullmatch(code) and code not in name_map:
+                codes.append(code)
+                name_map[code] = str(f.get(COL_META_NAME, "")).strip()
+        return codes, name_map
+
+_meta_store: "_MetaStore | None" = None
+
+def _meta(reload: bool = False) -> _MetaStore:
+    global _meta_store
+    if _meta_store is None:
+        _meta_store = _MetaStore()
+    elif reload:
+        _meta_store.load()
+    return _meta_store
+
+def _meta_get(key: str) -> str:
+    return _meta().get(key)
+
+def _meta_set(key: str, val: str, buf: "_WriteBuffer | None" = None):
+    """Ghi Meta[key]; nếu có buf thì chỉ đưa update/create vào hàng đợi ghi theo lô."""
+    _meta().set(key, val, buf)
 
 # ===== Persisted sets (warned caps & seen message_ids) =====
-def _warn_key_today() -> str:
-    return f"warn_caps_{_today_vn().strftime('%Y%m%d')}"
+def _chat_suffix(chat_id: str | None) -> str:
+    """Hậu tố key Meta theo nhóm; nhóm đầu tiên giữ nguyên tên key cũ (dữ liệu sẵn có vẫn dùng được)."""
+    if not chat_id or chat_id == (TELEGRAM_CHAT_IDS or [""])[0]:
+        return ""
+    return f"@{chat_id}"
+
+def _warn_key(chat_id: str | None = None, day=None) -> str:
+    return f"warn_caps_{_day_key(day or _today_vn())}{_chat_suffix(chat_id)}"
 
-def _seen_key_today() -> str:
-    return f"seen_msgids_{_today_vn().strftime('%Y%m%d')}"
+def _seen_key(chat_id: str | None = None, day=None) -> str:
+    return f"seen_msgids_{_day_key(day or _today_vn())}{_chat_suffix(chat_id)}"
 
+# Định dạng gọn (không cắt bớt):
+# - hash caption: "h1:" + base64(các hash 8 byte đã sort)
+# - message_id:   "r1:" + các đoạn liên tiếp "gap[.len]" (base36); gap tính từ cuối đoạn trước
 def _parse_hash_list(s: str) -> Set[str]:
+    s = (s or "").strip()
+    if s.startswith("h1:"):
+        try:
+            raw = base64.urlsafe_b64decode(s[3:] + "=" * (-len(s[3:]) % 4))
+        except ValueError:
+            return set()
+        n = CAP_HASH_HEX // 2
+        return {raw[i:i + n].hex() for i in range(0, len(raw) - n + 1, n)}
     out = set()
-    for tok in (s or "").split(","):
+    for tok in s.split(","):
         tok = tok.strip()
         if SHA1_RE.match(tok):
-            out.add(tok)
+            out.add(tok[:CAP_HASH_HEX])
     return out
 
 def _serialize_hash_list(vals: Set[str]) -> str:
     if not vals:
         return ""
-    return ",".join(sorted(vals))[:9000]
+    raw = b"".join(bytes.fromhex(h[:CAP_HASH_HEX]) for h in sorted(vals))
+    return "h1:" + base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
 def _parse_id_list(s: str) -> Set[int]:
+    s = (s or "").strip()
     out: Set[int] = set()
-    for tok in (s or "").split(","):
+    if s.startswith("r1:"):
+        prev = 0
+        for tok in s[3:].split(","):
+            if not tok:
+                continue
+            gap, _, extra = tok.partition(".")
+            try:
+                start = prev + int(gap, 36)
+                end = start + (int(extra, 36) if extra else 0)
+            except ValueError:
+                continue
+            out.update(range(start, end + 1))
+            prev = end
+        return out
+    for tok in s.split(","):
         tok = tok.strip()
         if tok.isdigit():
             out.add(int(tok))
     return out
 
+def _b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
 def _serialize_id_list(vals: Set[int]) -> str:
     if not vals:
         return ""
-    return ",".join(str(x) for x in sorted(vals))[:9000]
-
-def _load_warned_caps_persist() -> Set[str]:
-    return _parse_hash_list(_meta_get(_warn_key_today()))
-
-def _save_warned_caps_persist(vals: Set[str]):
-    _meta_set(_warn_key_today(), _serialize_hash_list(vals))
-
-def _load_seen_msgids_persist() -> Set[int]:
-    return _parse_id_list(_meta_get(_seen_key_today()))
-
-def _save_seen_msgids_persist(vals: Set[int]):
-    _meta_set(_seen_key_today(), _serialize_id_list(vals))
-
-# ===== Collector lock =====
-def _lock_key() -> str:
-    return "lock_collector"
-
-def _acquire_lock(ttl_sec: int = 180) -> bool:
-    """True nếu chiếm được lock; False nếu đang có lock còn hạn."""
-    now = int(time.time())
-    raw = _meta_get(_lock_key())
+    toks, prev = [], 0
+    ids = sorted(vals)
+    i = 0
+    while i < len(ids):
+        j = i
+        while j + 1 < len(ids) and ids[j + 1] == ids[j] + 1:
+            j += 1
+        tok = _b36(ids[i] - prev)
+        if j > i:
+            tok += "." + _b36(ids[j] - ids[i])
+        toks.append(tok)
+        prev = ids[j]
+        i = j + 1
+    return "r1:" + ",".join(toks)
+
+def _meta_get_chunked(key: str) -> str:
+    """Đọc giá trị đã chia nhỏ: key, key.1, key.2... (dừng ở phần rỗng/không có)."""
+    meta = _meta()
+    parts = [meta.get(key)]
+    i = 1
+    while parts[-1]:
+        parts.append(meta.get(f"{key}.{i}"))
+        i += 1
+    return "".join(parts)
+
+def _meta_set_chunked(key: str, val: str, buf=None):
+    parts = [val[i:i + META_CELL_MAX] for i in range(0, len(val), META_CELL_MAX)] or [""]
+    meta = _meta()
+    for i, part in enumerate(parts):
+        _meta_set(key if i == 0 else f"{key}.{i}", part, buf)
+    # Xoá các phần thừa của lần ghi trước (dài hơn)
+    i = len(parts)
+    while meta.get(f"{key}.{i}"):
+        _meta_set(f"{key}.{i}", "", buf)
+        i += 1
+
+# day: ngày VN của state (mặc định hôm nay) — state của ngày cũ lưu lúc qua ngày vẫn về đúng key ngày cũ
+def _load_warned_caps_persist(chat_id: str | None = None, day=None) -> Set[str]:
+    return _parse_hash_list(_meta_get_chunked(_warn_key(chat_id, day)))
+
+def _save_warned_caps_persist(vals: Set[str], buf=None, chat_id: str | None = None, day=None):
+    _meta_set_chunked(_warn_key(chat_id, day), _serialize_hash_list(vals), buf)
+
+def _load_seen_msgids_persist(chat_id: str | None = None, day=None) -> Set[int]:
+    return _parse_id_list(_meta_get_chunked(_seen_key(chat_id, day)))
+
+def _save_seen_msgids_persist(vals: Set[int], buf=None, chat_id: str | None = None, day=None):
+    _meta_set_chunked(_seen_key(chat_id, day), _serialize_id_list(vals), buf)
+
+# ===== Collector lock (lease riêng cho từng nhóm) =====
+LEASE_WAIT_SEC = int(os.getenv("LEASE_WAIT_SEC", "60"))   # chờ lease của nhóm do lần chạy khác giữ
+
+def _lock_key(chat_id: str | None = None) -> str:
+    return "lock_collector" + _chat_suffix(chat_id)
+
+def _lock_held(raw: str, ttl_sec: int, now: int) -> bool:
     try:
         ts = int(raw)
     except Exception:
         ts = 0
-    if ts and (now - ts) < ttl_sec:
+    return bool(ts) and (now - ts) < ttl_sec
+
+def _acquire_leases(chat_ids: List[str | None], ttl_sec: int = 180) -> Set[str | None]:
+    """Chiếm lease của các nhóm đang rảnh (1 lần đọc snapshot + 1 lần ghi theo lô).
+
+    Đọc lại snapshot Meta mới nhất; các lần đọc Meta sau đó trong lần chạy dùng snapshot này."""
+    now = int(time.time())
+    meta = _meta(reload=True)
+    buf = _WriteBuffer()
+    got = set()
+    for chat_id in chat_ids:
+        if not _lock_held(meta.get(_lock_key(chat_id)), ttl_sec, now):
+            _meta_set(_lock_key(chat_id), str(now), buf)
+            got.add(chat_id)
+    buf.flush()
+    return got
+
+def _wait_lease(chat_id: str | None, ttl_sec: int = 180, wait_sec: int = LEASE_WAIT_SEC) -> bool:
+    """Chờ lease của nhóm hết hạn/được nhả (đọc lại riêng key lock), tối đa wait_sec giây."""
+    deadline = time.monotonic() + wait_sec
+    key = _lock_key(chat_id)
+    while True:
+        if not _lock_held(_meta().refresh(key), ttl_sec, int(time.time())):
+            _meta_set(key, str(int(time.time())))
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(5)
+
+def _release_lock(buf: "_WriteBuffer | None" = None, chat_id: str | None = None):
+    _meta_set(_lock_key(chat_id), "", buf)
+
+def _release_leases(chat_ids):
+    """Nhả lease của các nhóm (1 lần ghi theo lô)."""
+    if not chat_ids:
+        return
+    buf = _WriteBuffer()
+    for chat_id in chat_ids:
+        _release_lock(buf, chat_id)
+    buf.flush()
+
+def _acquire_all_leases(chat_ids: List[str | None], ttl_sec: int = 180) -> bool:
+    """Giữ lease của MỌI nhóm (--serve/--webhook/--replay); thiếu nhóm nào thì nhả phần đã giữ, trả False."""
+    leased = _acquire_leases(chat_ids, ttl_sec)
+    if len(leased) < len(chat_ids):
+        _release_leases(leased)
         return False
-    _meta_set(_lock_key(), str(now))
     return True
 
-def _release_lock():
-    _meta_set(_lock_key(), "")
+def _read_lock_records() -> List[Dict[str, Any]]:
+    """Các record lock_collector* của Meta. Với Airtable gọi thẳng REST bằng requests (1 GET,
+    không nạp pyairtable): lần chạy cron rảnh không phải trả chi phí import."""
+    fields = [COL_META_KEY, COL_META_VAL]
+    if STORAGE_BACKEND != "airtable":
+        return _table(TBL_META).all(fields=fields, key_prefix=(COL_META_KEY, _lock_key()))
+    r = requests.get(f"{AIRTABLE_ENDPOINT_URL}/v0/{AIRTABLE_BASE_ID}/{quote(TBL_META, safe='')}",
+                     headers={"Authorization": f"Bearer {AIRTABLE_TOKEN}"},
+                     params={"filterByFormula": _prefix_formula(COL_META_KEY, _lock_key()), "fields[]": fields},
+                     timeout=30)
+    r.raise_for_status()
+    return r.json().get("records", [])
+
+def _leases_all_held(chat_ids: List[str | None], ttl_sec: int = 180) -> bool:
+    """Mọi nhóm đều đang bị giữ lease (--serve/--webhook)? Chỉ đọc các key lock (1 request nhỏ,
+    không nạp snapshot Meta); lỗi đọc thì coi như chưa bị giữ để lần chạy vẫn tiếp tục."""
+    try:
+        recs = _read_lock_records()
+    except _STORE_ERRORS as e:
+        print(f"[lease] lock check failed: {e}")
+        return False
+    vals = {str(r["fields"].get(COL_META_KEY, "")): str(r["fields"].get(COL_META_VAL, "") or "")
+            for r in recs}
+    now = int(time.time())
+    return all(_lock_held(vals.get(_lock_key(c), ""), ttl_sec, now) for c in chat_ids)
 
 # ===== Dedup helpers (ảnh/caption) =====
 def _photo_unique_ids(photo_sizes: List[Dict[str,Any]]) -> List[str]:
@@ -249,57 +1132,781 @@ def _photo_unique_ids(photo_sizes: List[Dict[str,Any]]) -> List[str]:
             ids.append(u)
     return ids
 
-def _load_seen_uids() -> Set[str]:
+# ---- Index cục bộ các file_unique_id của bảng Images (SQLite, đồng bộ tăng dần) ----
+IMG_INDEX_FILE = "images.sqlite"
+_U64 = (1 << 64) - 1
+
+class _ImageIndex:
+    """Bản sao cục bộ cột COL_IMG_HASH của bảng Images.
+
+    sync() chỉ kéo các record có createdTime >= watermark lần trước; `uid in index`
+    tra trên khoá chính SQLite, không cần tải lại cả bảng. Với STORAGE_BACKEND=sqlite (store)
+    UID tra thẳng records(tbl, uid) của store, không giữ bản sao; chỉ UID đã đánh dấu mà chưa
+    ghi (pending) nằm trong RAM."""
+
+    def __init__(self, path: str, store: "_SqliteStore | None" = None):
+        # Dùng chung giữa các worker của nhiều nhóm -> 1 connection + lock
+        self.lock = threading.RLock()
+        self.store = store
+        self.pending: Set[str] = set()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS uids (uid TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sync (k TEXT PRIMARY KEY, v TEXT)")
+        # dHash 64 bit + multi-index hashing: hash chia thành `parts` đoạn, mỗi đoạn 1 khoá tra cứu.
+        # Hamming <= t => ít nhất 1 đoạn lệch <= t // parts bit (pigeonhole) -> chỉ tra lân cận đó.
+        self.db.execute("CREATE TABLE IF NOT EXISTS phash (h INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS phash_part (part INTEGER, val INTEGER, h INTEGER, "
+                        "PRIMARY KEY (part, val, h)) WITHOUT ROWID")
+        self.parts = _phash_parts(PHASH_THRESHOLD)
+        row = self.db.execute("SELECT v FROM sync WHERE k='phash_parts'").fetchone()
+        if row is None or int(row[0]) != self.parts:
+            self.db.execute("DELETE FROM phash_part")
+            hs = [r[0] & _U64 for r in self.db.execute("SELECT h FROM phash")]
+            self.db.executemany("INSERT OR IGNORE INTO phash_part VALUES (?, ?, ?)",
+                                [t for h in hs for t in self._part_rows(h)])
+            self.db.execute("INSERT OR REPLACE INTO sync(k, v) VALUES ('phash_parts', ?)", (str(self.parts),))
+        self.db.commit()
+
+    def __contains__(self, uid) -> bool:
+        if self.store is not None:
+            with self.lock:
+                if uid in self.pending:
+                    return True
+            return self.store.has_uid(TBL_IMAGES, uid)
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM uids WHERE uid=?", (uid,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        if self.store is not None:
+            return self.store.count(TBL_IMAGES)
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM uids").fetchone()[0]
+
+    def add(self, uid: str):
+        with self.lock:
+            if self.store is not None:
+                self.pending.add(uid)
+                return
+            self.db.execute("INSERT OR IGNORE INTO uids(uid) VALUES (?)", (uid,))
+            self.db.commit()
+
+    def _part_rows(self, h: int):
+        bits = 64 // self.parts
+        mask = (1 << bits) - 1
+        return [(i, (h >> (i * bits)) & mask, _s64(h)) for i in range(self.parts)]
+
+    def _add_phash(self, h: int):
+        self.db.execute("INSERT OR IGNORE INTO phash(h) VALUES (?)", (_s64(h),))
+        self.db.executemany("INSERT OR IGNORE INTO phash_part VALUES (?, ?, ?)", self._part_rows(h))
+
+    def add_phash(self, h: int):
+        with self.lock:
+            self._add_phash(h)
+            self.db.commit()
+
+    def nearest_phash(self, h: int, max_dist: int):
+        """Khoảng cách Hamming nhỏ nhất tới một hash đã lưu nếu <= max_dist, ngược lại None.
+
+        Mỗi đoạn tra các giá trị lệch <= max_dist // parts bit (1 truy vấn IN/đoạn trên khoá chính);
+        chỉ so ứng viên tìm được, không quét cả bảng."""
+        best = None
+        bits = 64 // self.parts
+        with self.lock:
+            cand = set()
+            for part, val, _ in self._part_rows(h):
+                near = _bit_neighbours(val, bits, max_dist // self.parts)
+                cand.update(r[0] for r in self.db.execute(
+                    f"SELECT h FROM phash_part WHERE part=? AND val IN ({','.join('?' * len(near))})",
+                    (part, *near)))
+        for c in cand:
+            d = ((c & _U64) ^ h).bit_count()
+            if d <= max_dist and (best is None or d < best):
+                best = d
+        return best
+
+    def remove(self, uids: List[str]):
+        """Bỏ UID đã gộp vào Bloom filter lịch sử (--compact) hoặc đánh dấu tạm không ghi được."""
+        with self.lock:
+            self.pending.difference_update(uids)
+            self.db.executemany("DELETE FROM uids WHERE uid=?", [(u,) for u in uids])
+            self.db.commit()
+
+    def _get_wm(self) -> str:
+        row = self.db.execute("SELECT v FROM sync WHERE k='wm'").fetchone()
+        return row[0] if row else ""
+
+    def sync(self) -> int:
+        """Kéo các UID mới từ Airtable; trả về số record đã kéo."""
+        with self.lock:
+            return self._sync()
+
+    def _sync(self) -> int:
+        if self.store is not None and not COL_IMG_PHASH:
+            return 0   # UID tra thẳng store, không có pHash để kéo
+        wm = self._get_wm()
+        fields = [COL_IMG_HASH] + ([COL_IMG_PHASH] if COL_IMG_PHASH else [])
+        recs = _table(TBL_IMAGES).all(fields=fields, created_from=wm)
+        rows = []
+        for r in recs:
+            u = (r.get("fields") or {}).get(COL_IMG_HASH)
+            if u and self.store is None:
+                rows.append((u,))
+            ph = (r.get("fields") or {}).get(COL_IMG_PHASH) if COL_IMG_PHASH else None
+            if ph:
+                try:
+                    self._add_phash(int(ph, 16) & _U64)
+                except ValueError:
+                    pass
+            created = r.get("createdTime") or ""
+            if created > wm:
+                wm = created
+        self.db.executemany("INSERT OR IGNORE INTO uids(uid) VALUES (?)", rows)
+        self.db.execute("INSERT OR REPLACE INTO sync(k, v) VALUES ('wm', ?)", (wm,))
+        self.db.commit()
+        return len(recs)
+
+    def rebuild(self) -> int:
+        with self.lock:
+            self.db.execute("DELETE FROM uids")
+            self.db.execute("DELETE FROM phash")
+            self.db.execute("DELETE FROM phash_part")
+            self.db.execute("DELETE FROM sync WHERE k='wm'")
+            self.db.commit()
+            return self._sync()
+
+    def verify(self) -> Dict[str, int]:
+        """So sánh index với toàn bộ bảng Images (kéo full bảng — chỉ dùng khi bảo trì)."""
+        remote = set()
+        for r in _table(TBL_IMAGES).all(fields=[COL_IMG_HASH]):
+            u = (r.get("fields") or {}).get(COL_IMG_HASH)
+            if u:
+                remote.add(u)
+        with self.lock:
+            local = {row[0] for row in self.db.execute("SELECT uid FROM uids")} if self.store is None else remote
+        return {"remote": len(remote), "local": len(local),
+                "missing_local": len(remote - local), "extra_local": len(local - remote)}
+
+def _open_image_index() -> _ImageIndex:
+    store = _get_sqlite_store() if STORAGE_BACKEND == "sqlite" else None
+    return _ImageIndex(_state_path(IMG_INDEX_FILE), store)
+
+_image_index: "_ImageIndex | None" = None
+
+def _load_seen_uids():
+    """Tập UID ảnh đã dùng: index cục bộ (đã sync) nếu bật bảng Images, ngược lại set rỗng.
+
+    Index dùng chung cho mọi nhóm trong tiến trình (ảnh trùng giữa các nhóm vẫn bị chặn)."""
+    global _image_index
     if not TBL_IMAGES:
         return set()
-    tbl = _air_table(TBL_IMAGES)
+    if _image_index is None:
+        _image_index = _open_image_index()
+    idx = _image_index
     try:
-        recs = tbl.all(fields=[COL_IMG_HASH])
-    except HTTPError:
-        return set()
-    s = set()
-    for r in recs:
-        u = (r.get("fields") or {}).get(COL_IMG_HASH)
-        if u: s.add(u)
-    return s
+        idx.sync()
+    except HTTPError as e:
+        # Không sync được thì vẫn dùng dữ liệu đã có trong index
+        print(f"[images] sync failed, using local index: {e}")
+    return idx
+
+def _is_duplicate_photo(ids: List[str], seen) -> bool:
+    hist = _history_filter()
+    return any(uid in seen or (hist is not None and f"i:{uid}" in hist) for uid in ids)
+
+def _near_duplicate_photo(phashes: "Dict[str, int] | None", seen):
+    """Khoảng cách Hamming nhỏ nhất tới ảnh đã lưu (<= PHASH_THRESHOLD) hoặc None."""
+    if not phashes or not isinstance(seen, _ImageIndex):
+        return None
+    dists = [d for d in (seen.nearest_phash(h, PHASH_THRESHOLD) for h in phashes.values()) if d is not None]
+    return min(dists) if dists else None
+
+def _claim_photo_ids(ids: List[str], seen) -> List[str]:
+    """Đánh dấu tạm các UID chưa có (chặn trùng trong cùng lô, trước khi ghi); trả về UID mới."""
+    new = [u for u in dict.fromkeys(ids) if u not in seen]
+    for uid in new:
+        seen.add(uid)
+    return new
 
-def _is_duplicate_photo(ids: List[str], seen: Set[str]) -> bool:
-    return any(uid in seen for uid in ids)
+def _release_photo_ids(ids: List[str], seen):
+    """Bỏ đánh dấu của _claim_photo_ids khi báo cáo không ghi được."""
+    if isinstance(seen, _ImageIndex):
+        seen.remove(ids)
+    else:
+        for uid in ids:
+            seen.discard(uid)
 
-def _save_photo_ids(code: str, ids: List[str], seen: Set[str]):
+def _save_photo_ids(code: str, ids: List[str], seen, buf: "_WriteBuffer | None" = None,
+                    phashes: "Dict[str, int] | None" = None):
+    """Ghi record Images cho các UID mới (đã đánh dấu bằng _claim_photo_ids)."""
     if not TBL_IMAGES or not ids:
         return
-    tbl = _air_table(TBL_IMAGES)
     today = _today_vn().isoformat()
     for uid in ids:
-        if uid in seen:
+        fields = {COL_IMG_HASH: uid, COL_IMG_CODE: code, COL_IMG_DATE: today}
+        h = (phashes or {}).get(uid)
+        if h is not None:
+            if COL_IMG_PHASH:
+                fields[COL_IMG_PHASH] = f"{h:016x}"
+            if isinstance(seen, _ImageIndex):
+                seen.add_phash(h)
+        if buf is not None:
+            buf.create(TBL_IMAGES, fields)
+        else:
+            _table(TBL_IMAGES).create(fields)
+
+# ---- Perceptual hash (tuỳ chọn): bắt ảnh chụp lại / crop / nén lại — cần Pillow + TBL_IMAGES ----
+PHASH_ENABLE        = os.getenv("PHASH_ENABLE", "0") == "1"
+PHASH_THRESHOLD     = int(os.getenv("PHASH_THRESHOLD", "6"))      # Hamming tối đa trên 64 bit để coi là trùng
+PHASH_WORKERS       = int(os.getenv("PHASH_WORKERS", "2"))        # số process hash
+PHASH_TIMEOUT_SEC   = float(os.getenv("PHASH_TIMEOUT_SEC", "20")) # quá hạn thì bỏ qua (không chặn collector)
+
+_phash_ok: "bool | None" = None
+_phash_exec = None
+_phash_lock = threading.Lock()
+
+def _phash_parts(threshold: int) -> int:
+    """Số đoạn của multi-index: 4 đoạn 16 bit (mỗi đoạn tra lân cận <= threshold // 4 bit, ~N/65536
+    ứng viên/giá trị); ngưỡng lớn thì 8 đoạn 8 bit để lân cận cần tra không quá rộng."""
+    return 4 if threshold < 12 else 8
+
+def _bit_neighbours(val: int, bits: int, radius: int) -> List[int]:
+    """Mọi giá trị `bits` bit lệch val không quá radius bit."""
+    out = [val]
+    for r in range(1, min(radius, bits) + 1):
+        for pos in itertools.combinations(range(bits), r):
+            x = val
+            for b in pos:
+                x ^= 1 << b
+            out.append(x)
+    return out
+
+def _s64(h: int) -> int:
+    """uint64 -> int64 (SQLite INTEGER)."""
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+def _dhash_bytes(data: bytes):
+    """dHash 64 bit của ảnh (chạy trong process pool); None nếu không đọc được ảnh."""
+    import io
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            px = list(im.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | int(px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+def _phash_available() -> bool:
+    global _phash_ok
+    if _phash_ok is None:
+        import importlib.util
+        _phash_ok = PHASH_ENABLE and bool(TBL_IMAGES) and importlib.util.find_spec("PIL") is not None
+        if PHASH_ENABLE and not _phash_ok:
+            print("[phash] disabled: needs Pillow installed and TBL_IMAGES configured")
+    return _phash_ok
+
+def _phash_executors():
+    """(thread pool tải ảnh, process pool hash) — tạo 1 lần, dùng chung mọi nhóm."""
+    global _phash_exec
+    with _phash_lock:
+        if _phash_exec is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            _phash_exec = (ThreadPoolExecutor(PHASH_WORKERS * 4, thread_name_prefix="phash-dl"),
+                           ProcessPoolExecutor(PHASH_WORKERS, mp_context=multiprocessing.get_context("spawn")))
+    return _phash_exec
+
+def _smallest_photo(photo_sizes: List[Dict[str, Any]]):
+    return min(photo_sizes, key=lambda p: (p.get("width", 0) * p.get("height", 0), p.get("file_size", 0)),
+               default=None)
+
+def _photo_phashes(updates: List[Dict[str, Any]], st) -> Dict[str, int]:
+    """dHash cỡ ảnh nhỏ nhất của mỗi tin có ảnh trong lô: {file_unique_id: hash}.
+
+    Tải song song (getFile), hash trong process pool. Ảnh đã trùng UID / tin đã xử lý thì bỏ
+    qua; lỗi hoặc quá PHASH_TIMEOUT_SEC thì ảnh đó không có hash (chỉ còn so UID)."""
+    if not _phash_available():
+        return {}
+    todo: Dict[str, str] = {}
+    for u in updates:
+        msg = u.get("message") or {}
+        if str((msg.get("chat") or {}).get("id", "")) != st.chat_id or msg.get("message_id") in st.seen_msgids_day:
             continue
-        tbl.create({COL_IMG_HASH: uid, COL_IMG_CODE: code, COL_IMG_DATE: today})
-        seen.add(uid)
+        small = _smallest_photo(msg.get("photo") or [])
+        uid = (small or {}).get("file_unique_id")
+        if uid and small.get("file_id") and uid not in st.seen_uids:
+            todo.setdefault(uid, small["file_id"])
+    if not todo:
+        return {}
+    from concurrent.futures import wait
+    dl, pool = _phash_executors()
+    futs = {dl.submit(lambda fid: pool.submit(_dhash_bytes, _tg_file(fid)).result(), fid): uid
+            for uid, fid in todo.items()}
+    done, _ = wait(futs, timeout=PHASH_TIMEOUT_SEC)
+    out: Dict[str, int] = {}
+    for f in done:
+        try:
+            h = f.result()
+        except Exception as e:
+            print(f"[phash] {futs[f]}: {e}")
+            continue
+        if h is not None:
+            out[futs[f]] = h
+    if len(out) < len(todo):
+        print(f"[phash] hashed {len(out)}/{len(todo)} photo(s)")
+    return out
+
+# ---- Lịch sử đã gộp (--compact): Bloom filter các UID ảnh / caption cũ ----
+COMPACT_DAYS        = int(os.getenv("COMPACT_DAYS", "180"))      # giữ record N ngày gần nhất trên Airtable
+BLOOM_FPR           = float(os.getenv("BLOOM_FPR", "0.001"))     # tỉ lệ dương tính giả tối đa của cả filter
+BLOOM_FILE          = "history.bloom"
+ARCHIVE_DIR         = os.getenv("ARCHIVE_DIR", "archive")         # nơi ghi record cũ (jsonl.gz) trước khi xoá
+
+class _Bloom:
+    """Bloom filter m bit, k hàm băm (double hashing trên blake2b 128 bit)."""
+
+    def __init__(self, m: int, k: int, bits: "bytearray | None" = None, n: int = 0):
+        self.m, self.k, self.n = m, k, n
+        self.bits = bits if bits is not None else bytearray((m + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, n: int, fpr: float) -> "_Bloom":
+        n = max(1, n)
+        m = max(64, math.ceil(-n * math.log(fpr) / (math.log(2) ** 2)))
+        return cls(m, max(1, round(m / n * math.log(2))))
+
+    def _positions(self, key: str):
+        d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        return [(h1 + i * h2 + (i * i * i - i) // 6) % self.m for i in range(self.k)]   # enhanced double hashing
+
+    def add(self, key: str):
+        for i in self._positions(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.n += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[i >> 3] >> (i & 7) & 1 for i in self._positions(key))
+
+class _BloomHistory:
+    """Bloom filter mở rộng dần: mỗi lần --compact thêm 1 lớp đúng cỡ phần lịch sử vừa gộp.
+
+    FPR lớp thứ i là BLOOM_FPR / 2^(i+1) nên tổng FPR của cả filter vẫn < BLOOM_FPR."""
+    MAGIC = b"BLM1"
+
+    def __init__(self, layers: "List[_Bloom] | None" = None):
+        self.layers = layers or []
+
+    def __contains__(self, key: str) -> bool:
+        return any(key in b for b in self.layers)
+
+    def __len__(self) -> int:
+        return sum(b.n for b in self.layers)
+
+    def add_layer(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        b = _Bloom.for_capacity(len(keys), BLOOM_FPR / 2 ** (len(self.layers) + 1))
+        for key in keys:
+            b.add(key)
+        self.layers.append(b)
+
+    def to_bytes(self) -> bytes:
+        out = [self.MAGIC + struct.pack("<I", len(self.layers))]
+        for b in self.layers:
+            out += [struct.pack("<QIQ", b.m, b.k, b.n), bytes(b.bits)]
+        return b"".join(out)
+
+    def save(self, path: str):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "_BloomHistory | None":
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return cls.from_bytes(data, path)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, name: str = "bloom") -> "_BloomHistory | None":
+        if data[:4] != cls.MAGIC:
+            print(f"[compact] {name}: not a bloom history file, ignored")
+            return None
+        (count,), pos, layers = struct.unpack_from("<I", data, 4), 8, []
+        for _ in range(count):
+            m, k, n = struct.unpack_from("<QIQ", data, pos)
+            pos += struct.calcsize("<QIQ")
+            size = (m + 7) // 8
+            layers.append(_Bloom(m, k, bytearray(data[pos:pos + size]), n))
+            pos += size
+        return cls(layers)
+
+# Bản bền vững trong Meta (STATE_DIR là cache, có thể bị xoá): header "gen:số phần:sha256" ở key
+# BLOOM_META_KEY, các phần base64 ở BLOOM_META_KEY:gen.i (ngoài snapshot Meta, chỉ tải khi file cục bộ thiếu/cũ)
+BLOOM_META_KEY      = "history_bloom"
+
+def _save_history_durable(hist: "_BloomHistory"):
+    """Ghi filter vào Meta: các phần mới -> header (điểm commit) -> xoá phần của lần trước.
+
+    Lỗi ở bất kỳ bước ghi nào đều raise (--compact không được xoá record khi chưa lưu xong)."""
+    raw = hist.to_bytes()
+    b64 = base64.b64encode(raw).decode("ascii")
+    parts = [b64[i:i + META_CELL_MAX] for i in range(0, len(b64), META_CELL_MAX)]
+    gen = str(time.time_ns())
+    tbl = _table(TBL_META)
+    recs = [{COL_META_KEY: f"{BLOOM_META_KEY}:{gen}.{i}", COL_META_VAL: p} for i, p in enumerate(parts)]
+    for chunk in _chunks(recs, tbl.batch_size):
+        tbl.batch_create(chunk)
+    buf = _WriteBuffer()
+    _meta_set(BLOOM_META_KEY, f"{gen}:{len(parts)}:{hashlib.sha256(raw).hexdigest()}", buf)
+    if buf.flush():
+        raise RuntimeError("could not write the bloom filter header to Meta")
+    old = [r["id"] for r in tbl.all(fields=[COL_META_KEY], key_prefix=(COL_META_KEY, BLOOM_META_KEY + ":"))
+           if not str(r["fields"].get(COL_META_KEY, "")).startswith(f"{BLOOM_META_KEY}:{gen}.")]
+    for chunk in _chunks(old, tbl.batch_size):
+        tbl.batch_delete(chunk)
+
+def _load_history_durable(header: str) -> "bytes | None":
+    gen, n, digest = header.split(":")
+    recs = _table(TBL_META).all(key_prefix=(COL_META_KEY, f"{BLOOM_META_KEY}:{gen}."))
+    parts = {str(r["fields"].get(COL_META_KEY, "")).rsplit(".", 1)[-1]: r["fields"].get(COL_META_VAL, "")
+             for r in recs}
+    raw = base64.b64decode("".join(parts.get(str(i), "") for i in range(int(n))))
+    if hashlib.sha256(raw).hexdigest() != digest:
+        print("[compact] bloom filter in Meta is incomplete, ignored")
+        return None
+    return raw
+
+_history: Any = False   # False = chưa nạp; None = chưa từng --compact
+
+def _history_filter() -> "_BloomHistory | None":
+    """Filter lịch sử: file trong STATE_DIR nếu khớp header trong Meta, ngược lại tải lại từ Meta."""
+    global _history
+    if _history is False:
+        path = _state_path(BLOOM_FILE)
+        header = _meta_get(BLOOM_META_KEY)
+        try:
+            with open(path, "rb") as f:
+                local = f.read()
+        except FileNotFoundError:
+            local = None
+        if header and (local is None or hashlib.sha256(local).hexdigest() != header.rsplit(":", 1)[-1]):
+            try:
+                raw = _load_history_durable(header)
+            except (HTTPError, ValueError) as e:
+                print(f"[compact] could not load bloom filter from Meta: {e}")
+                raw = None
+            if raw is not None:
+                local = raw
+                with open(path + ".tmp", "wb") as f:
+                    f.write(raw)
+                os.replace(path + ".tmp", path)
+        _history = _BloomHistory.from_bytes(local, path) if local else None
+    return _history
+
+def _history_caption_key(chat_id: str, text: str) -> str:
+    chat = str(chat_id or "") if COL_MSG_CHAT else ""
+    return "c:" + chat + ":" + hashlib.sha1(_normalize_caption(text).encode("utf-8")).hexdigest()[:CAP_HASH_HEX]
 
 def _hash_caption(text: str) -> str:
-    return hashlib.sha1((text or "").strip().encode("utf-8")).hexdigest()
+    return hashlib.sha1((text or "").strip().encode("utf-8")).hexdigest()[:CAP_HASH_HEX]
+
+# ===== Messages theo ngày (lọc phía server + watermark) =====
+def _msgday_state_name(day) -> str:
+    return f"msgday_{_day_key(day)}.json"
 
-def _load_today_caption_hashes() -> Set[str]:
-    """Hash của caption đã LƯU vào bảng Messages trong NGÀY HÔM NAY."""
-    tbl = _air_table(TBL_MESSAGES)
+def _query_messages_created(start_ts: str, end_ts: str):
+    tbl = _table(TBL_MESSAGES)
+    fields = [COL_MSG_TEXT, COL_MSG_CODE] + ([COL_MSG_CHAT] if COL_MSG_CHAT else [])
     try:
-        recs = tbl.all(fields=[COL_MSG_TEXT])
+        return tbl.all(fields=fields + [COL_MSG_TS], created_from=start_ts, created_before=end_ts)
     except HTTPError:
-        return set()
-    today = _today_vn()
-    hashes: Set[str] = set()
-    for r in recs:
-        fields = r.get("fields", {}) or {}
-        created = r.get("createdTime")
-        ts_dt = _iso_local(created) if isinstance(created, str) else created
-        if not ts_dt:
+        # Bảng không có cột Timestamp -> bỏ cột này
+        return tbl.all(fields=fields, created_from=start_ts, created_before=end_ts)
+
+_msgday_lock = threading.Lock()   # các worker nhóm dùng chung 1 file cache
+
+def _fetch_day_messages(day=None) -> Dict[str, Dict[str, Any]]:
+    """Record Messages tạo trong NGÀY (giờ VN): {record_id: {text, code, ts}}.
+
+    Airtable lọc theo CREATED_TIME() trong [đầu ngày, cuối ngày); kết quả được cache cục bộ
+    kèm watermark (createdTime lớn nhất đã thấy) nên các lần chạy sau chỉ kéo record mới."""
+    day = day or _today_vn()
+    with _msgday_lock:
+        return _fetch_day_messages_locked(day)
+
+def _fetch_day_messages_locked(day) -> Dict[str, Dict[str, Any]]:
+    name = _msgday_state_name(day)
+    cache = _load_json_state(name) or {}
+    recs: Dict[str, Dict[str, Any]] = cache.get("recs") or {}
+    start, end = _vn_day_bounds_utc(day)
+    wm = max(cache.get("wm") or start, start)
+
+    # Lấy cả record có createdTime == watermark (trùng thì ghi đè theo record id)
+    for r in _query_messages_created(wm, end):
+        f = r.get("fields", {}) or {}
+        created = r.get("createdTime") or ""
+        recs[r["id"]] = {
+            "text": str(f.get(COL_MSG_TEXT, "") or ""),
+            "code": str(f.get(COL_MSG_CODE, "") or ""),
+            "ts":   f.get(COL_MSG_TS) or created,
+            "chat": str(f.get(COL_MSG_CHAT, "") or "") if COL_MSG_CHAT else "",
+        }
+        if created > wm:
+            wm = created
+
+    _save_json_state(name, {"wm": wm, "recs": recs})
+    if day == _today_vn():
+        _prune_state("msgday_", {name, _msgday_state_name(day - datetime.timedelta(days=1))})
+    return recs
+
+def _chat_records(recs: Dict[str, Dict[str, Any]], chat_id: str | None):
+    """Lọc record theo nhóm khi Messages có cột chat (COL_MSG_CHAT); không có thì dùng chung."""
+    if not COL_MSG_CHAT or not chat_id:
+        return list(recs.values())
+    return [r for r in recs.values() if r.get("chat") == str(chat_id)]
+
+def _load_today_caption_hashes(chat_id: str | None = None, recs=None) -> Set[str]:
+    """Hash của caption đã LƯU vào bảng Messages trong NGÀY HÔM NAY (recs: kết quả _fetch_day_messages() nếu đã có)."""
+    if recs is None:
+        try:
+            recs = _fetch_day_messages()
+        except HTTPError:
+            return set()
+    return {_hash_caption(r["text"]) for r in _chat_records(recs, chat_id)}
+
+# ---- Caption gần trùng (tuỳ chọn): MinHash + LSH, index SQLite giữ qua các ngày ----
+CAPSIM_ENABLE       = os.getenv("CAPSIM_ENABLE", "0") == "1"
+CAPSIM_THRESHOLD    = float(os.getenv("CAPSIM_THRESHOLD", "0.8"))  # độ giống (Jaccard ước lượng) tối thiểu
+CAPSIM_WINDOW_DAYS  = int(os.getenv("CAPSIM_WINDOW_DAYS", "1"))    # so với caption N ngày gần nhất (1 = hôm nay)
+CAP_INDEX_FILE      = "captions.sqlite"
+MINHASH_PERM        = 64                 # 16 band x 4 hàng: cặp giống ~0.8 gần như chắc chắn thành ứng viên
+LSH_BANDS           = 16
+SHINGLE_LEN         = 4                  # shingle ký tự
+_MH_PRIME = (1 << 61) - 1
+_MH_COEF = [((i * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) % _MH_PRIME or 1,
+             (i * 0xC2B2AE3D27D4EB4F + 0x165667B19E3779F9) % _MH_PRIME) for i in range(1, MINHASH_PERM + 1)]
+
+def _normalize_caption(text: str) -> str:
+    """Chữ thường, bỏ dấu, gộp khoảng trắng/dấu câu; chữ số sau mã 8 số -> '0'."""
+    t = unicodedata.normalize("NFD", (text or "").lower()).replace("đ", "d")
+    t = "".join(c for c in t if unicodedata.category(c) != "Mn")
+    m = re.match(r"\s*(\d{8})", t)
+    head, rest = (m.group(1), t[m.end():]) if m else ("", t)
+    rest = re.sub(r"\d+", "0", rest)
+    rest = re.sub(r"[\W_]+", " ", rest)
+    return " ".join((head + " " + rest).split())
+
+def _minhash(norm: str) -> List[int]:
+    sh = {norm[i:i + SHINGLE_LEN] for i in range(max(1, len(norm) - SHINGLE_LEN + 1))}
+    xs = [int.from_bytes(hashlib.blake2b(x.encode("utf-8"), digest_size=8).digest(), "big") for x in sh]
+    return [min((a * x + b) % _MH_PRIME for x in xs) for a, b in _MH_COEF]
+
+def _sig_similarity(a: List[int], b: List[int]) -> float:
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+def _h64(data: bytes) -> int:
+    return _s64(int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big"))
+
+class _CaptionIndex:
+    """Chữ ký MinHash của caption đã ghi nhận + bảng LSH (band -> id) trong SQLite.
+
+    Tra cứu: 16 lần tra khoá chính (mỗi band một lần) lấy ứng viên rồi so chữ ký; không quét
+    lịch sử. Nạp từ record Messages theo ngày (_fetch_day_messages, đã cache) nên không tốn
+    thêm lời gọi Airtable; chỉ giữ CAPSIM_WINDOW_DAYS ngày gần nhất."""
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS caps (id INTEGER PRIMARY KEY, chat TEXT, code TEXT, day TEXT, "
+                        "sig BLOB)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS caps_day ON caps(day)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER, key INTEGER, id INTEGER, "
+                        "PRIMARY KEY (band, key, id)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS bands_id ON bands(id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sync (k TEXT PRIMARY KEY, v TEXT)")
+        self.db.commit()
+
+    @staticmethod
+    def _band_keys(sig: List[int]):
+        rows = MINHASH_PERM // LSH_BANDS
+        return [(b, _h64(struct.pack(f"<{rows}Q", *sig[b * rows:(b + 1) * rows]))) for b in range(LSH_BANDS)]
+
+    def _add(self, chat: str, code: str, day: str, norm: str) -> bool:
+        cid = _h64(f"{chat}|{day}|{norm}".encode("utf-8"))
+        if self.db.execute("SELECT 1 FROM caps WHERE id=?", (cid,)).fetchone():
+            return False
+        sig = _minhash(norm)
+        self.db.execute("INSERT INTO caps(id, chat, code, day, sig) VALUES (?, ?, ?, ?, ?)",
+                        (cid, chat, code, day, struct.pack(f"<{MINHASH_PERM}Q", *sig)))
+        self.db.executemany("INSERT OR IGNORE INTO bands VALUES (?, ?, ?)",
+                            [(b, k, cid) for b, k in self._band_keys(sig)])
+        return True
+
+    def add(self, chat: str, day: str, text: str):
+        with self.lock:
+            self._add(str(chat), _extract_code(text), day, _normalize_caption(text))
+            self.db.commit()
+
+    def best_match(self, chat: str, text: str, since_day: str):
+        """Độ giống lớn nhất (>= CAPSIM_THRESHOLD) với caption đã ghi nhận của nhóm từ since_day.
+
+        Chỉ so với caption cùng mã nơi: các kho dùng chung mẫu caption không bị coi là trùng nhau."""
+        sig = _minhash(_normalize_caption(text))
+        with self.lock:
+            ids = set()
+            for b, k in self._band_keys(sig):
+                ids.update(r[0] for r in self.db.execute("SELECT id FROM bands WHERE band=? AND key=?", (b, k)))
+            rows = []
+            for i in range(0, len(ids), 500):
+                part = list(ids)[i:i + 500]
+                rows += self.db.execute(
+                    f"SELECT sig FROM caps WHERE id IN ({','.join('?' * len(part))}) AND chat=? AND code=? "
+                    "AND day>=?", part + [str(chat), _extract_code(text), since_day]).fetchall()
+        best = None
+        for (blob,) in rows:
+            sim = _sig_similarity(sig, list(struct.unpack(f"<{MINHASH_PERM}Q", blob)))
+            if sim >= CAPSIM_THRESHOLD and (best is None or sim > best):
+                best = sim
+        return best
+
+    def load_days(self, today, chats: List[str], today_recs=None):
+        """Nạp caption đã lưu của các ngày trong cửa sổ; ngày đã qua chỉ nạp 1 lần, hôm nay nạp phần mới.
+
+        today_recs: record hôm nay đã kéo sẵn (tránh gọi Airtable lần nữa)."""
+        first = today - datetime.timedelta(days=max(1, CAPSIM_WINDOW_DAYS) - 1)
+        with self.lock:
+            done = {r[0] for r in self.db.execute("SELECT k FROM sync")}
+        day = first
+        while day <= today:
+            key = f"day:{_day_key(day)}"
+            if key not in done:
+                recs = today_recs if day == today and today_recs is not None else _fetch_day_messages(day)
+                with self.lock:
+                    for chat in chats:
+                        for r in _chat_records(recs, chat):
+                            if r.get("text"):
+                                self._add(str(chat), str(r.get("code") or "").strip() or _extract_code(r["text"]), day.isoformat(),
+                                          _normalize_caption(r["text"]))
+                    if day < today:
+                        self.db.execute("INSERT OR REPLACE INTO sync(k, v) VALUES (?, '1')", (key,))
+                    self.db.commit()
+            day += datetime.timedelta(days=1)
+        with self.lock:
+            old = first.isoformat()
+            self.db.execute("DELETE FROM bands WHERE id IN (SELECT id FROM caps WHERE day < ?)", (old,))
+            self.db.execute("DELETE FROM caps WHERE day < ?", (old,))
+            self.db.execute("DELETE FROM sync WHERE k < ?", (f"day:{_day_key(first)}",))
+            self.db.commit()
+
+_caption_index: "_CaptionIndex | None" = None
+_caption_index_lock = threading.Lock()
+
+def _load_caption_index(chat_id: str, today_recs=None, day=None):
+    """Index caption gần trùng (None nếu tắt CAPSIM_ENABLE); dùng chung mọi nhóm trong tiến trình.
+
+    day: ngày của state (replay tin ngày cũ), mặc định hôm nay; today_recs là record của ngày đó."""
+    global _caption_index
+    if not CAPSIM_ENABLE:
+        return None
+    with _caption_index_lock:
+        if _caption_index is None:
+            _caption_index = _CaptionIndex(_state_path(CAP_INDEX_FILE))
+    try:
+        _caption_index.load_days(day or _today_vn(), [chat_id], today_recs)
+    except HTTPError as e:
+        print(f"[captions] load failed, using local index: {e}")
+    return _caption_index
+
+def _message_item(r: Dict[str, Any]):
+    """Record Messages (dạng cache) -> {code, text, ts}; None nếu không xác định được mã/thời gian."""
+    text = r["text"].strip()
+    code = r["code"].strip()
+    ts   = r["ts"]
+    ts_dt = _iso_local(ts) if isinstance(ts, str) else ts
+    if not code:
+        m = CODE_RE.match(text)
+        if not m:
+            return None
+        code = m.group(1)
+    if not ts_dt:
+        return None
+    return {"code": code, "text": text, "ts": ts_dt}
+
+# ===== Rollup theo ngày: mã nơi -> báo cáo mới nhất (collector cập nhật, báo cáo 21h chỉ đọc) =====
+def _rollup_key(day, chat_id: str | None = None) -> str:
+    return f"rollup_{_day_key(day)}{_chat_suffix(chat_id)}"
+
+def _short_text(text: str, limit: int = 90) -> str:
+    txt = (text or "").replace("\n", " ")
+    if len(txt) > limit:
+        txt = txt[:limit - 3] + "..."
+    return txt
+
+def _rollup_from_messages(day, chat_id: str | None = None) -> Dict[str, list]:
+    """Dựng lại rollup từ Messages của ngày (truy vấn theo ngày, không quét cả bảng)."""
+    roll: Dict[str, list] = {}
+    for r in _chat_records(_fetch_day_messages(day), chat_id):
+        it = _message_item(r)
+        if not it:
+            continue
+        ts = int(it["ts"].timestamp())
+        if it["code"] not in roll or ts >= roll[it["code"]][0]:
+            roll[it["code"]] = [ts, _short_text(it["text"])]
+    return roll
+
+def _load_rollup(day, chat_id: str | None = None, rebuild: bool = True):
+    """Rollup {code: [epoch giây, text rút gọn]} từ Meta; chưa có thì dựng từ Messages (hoặc None)."""
+    raw = _meta_get_chunked(_rollup_key(day, chat_id))
+    if raw:
+        try:
+            roll = json.loads(raw)
+            if isinstance(roll, dict):
+                return roll
+        except ValueError:
+            pass
+    return _rollup_from_messages(day, chat_id) if rebuild else None
+
+def _save_rollup(day, roll: Dict[str, list], buf=None, chat_id: str | None = None):
+    _meta_set_chunked(_rollup_key(day, chat_id),
+                      json.dumps(roll, ensure_ascii=False, separators=(",", ":"), sort_keys=True), buf)
+
+def _rollup_items(roll: Dict[str, list]):
+    return [{"code": c, "text": v[1], "ts": v[0]} for c, v in sorted(roll.items())]
+
+# ---- Dọn key theo ngày trong Meta (snapshot Meta đọc cả bảng mỗi lần chạy -> không để tích luỹ) ----
+META_DAY_KEY_RE = re.compile(r"^(rollup|warn_caps|seen_msgids)_(\d{8})(?:@([^.]+))?(?:\.\d+)?$")
+META_KEEP_DAYS  = 2   # hôm nay + hôm qua (state ngày cũ còn được lưu lúc qua ngày)
+
+def _prune_meta_days() -> int:
+    """Xoá các key rollup_/warn_caps_/seen_msgids_ cũ hơn META_KEEP_DAYS ngày.
+
+    Rollup ngày cũ được ghi vào cache snapshot cục bộ (--report) trước khi xoá; thiếu cache thì
+    --report dựng lại từ Messages của đúng ngày đó (truy vấn theo ngày, không quét cả bảng)."""
+    keep_from = _day_key(_today_vn() - datetime.timedelta(days=META_KEEP_DAYS - 1))
+    old = []
+    for key in _meta().keys():
+        m = META_DAY_KEY_RE.match(key)
+        if not m or m.group(2) >= keep_from:
             continue
-        if ts_dt.astimezone(VN_TZ).date() == today:
-            caption = fields.get(COL_MSG_TEXT, "")
-            h = hashlib.sha1((caption or "").strip().encode("utf-8")).hexdigest()
-            hashes.add(h)
-    return hashes
+        if m.group(1) == "rollup" and "." not in key:
+            day = datetime.datetime.strptime(m.group(2), "%Y%m%d").date()
+            _day_snapshot(day, m.group(3))
+        old.append(key)
+    if old:
+        n = _meta().delete(old)
+        print(f"[meta] pruned {n} past-day record(s)")
+    return len(old)
 
 # ===== Collector (*/15) — ACK trước, gộp album, dedup, persist warn & seen =====
 def _extract_code(text: str) -> str:
@@ -308,218 +1915,972 @@ def _extract_code(text: str) -> str:
     m = CODE_RE.match(text.strip())
     return m.group(1) if m else ""
 
-def collect_once():
-    # --- Acquire lock để tránh chạy trùng ---
-    if not _acquire_lock(ttl_sec=180):
-        return
-    try:
-        # 1) Đọc offset hiện tại
-        offset = _meta_get("last_update_id")
-        offset = int(offset) + 1 if offset else None
-
-        # 2) Kéo tất cả updates kể từ offset
-        resp = _tg("getUpdates", timeout=10, allowed_updates=["message"], offset=offset)
-        updates = resp.get("result", [])
-
-        # 3) ACK HÀNG ĐỢI TRƯỚC: nếu có update, đẩy offset lên max+1 (xoá update cũ khỏi server)
-        max_uid = None
-        for u in updates:
-            uid = u.get("update_id")
-            if isinstance(uid, int):
-                max_uid = uid if max_uid is None else max(max_uid, uid)
-        if max_uid is not None:
-            _meta_set("last_update_id", str(max_uid))
+# ---- Nạp song song bộ nhớ chống trùng (bước 4) ----
+PREFETCH_WORKERS    = int(os.getenv("PREFETCH_WORKERS", "4"))
+PREFETCH_TIMEOUT_SEC = float(os.getenv("PREFETCH_TIMEOUT_SEC", "60"))   # mỗi nguồn; quá hạn -> fail-open
+
+def _prefetch(sources: Dict[str, tuple]) -> Dict[str, Any]:
+    """Chạy các hàm nạp độc lập song song: sources = {name: (fn, default, timeout_sec)}.
+
+    Nguồn lỗi hoặc quá timeout thì dùng default (fail-open: có thể lọt trùng nhưng không chặn
+    báo cáo). Request Airtable của mọi thread đi chung session (connection pool) của _get_api()."""
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+    def run(name, fn):
+        with _metrics.phase(f"load_{name}"):
+            return fn()
+
+    pool = ThreadPoolExecutor(max(1, min(PREFETCH_WORKERS, len(sources))), thread_name_prefix="prefetch")
+    started = time.monotonic()
+    futs = {name: pool.submit(run, name, fn) for name, (fn, _, _) in sources.items()}
+    out: Dict[str, Any] = {}
+    for name, fut in futs.items():
+        _, default, timeout = sources[name]
+        try:
+            out[name] = fut.result(timeout=max(0.0, started + timeout - time.monotonic()))
+        except FutureTimeout:
+            print(f"[prefetch] {name}: no result after {timeout:g}s, continuing without it")
+            out[name] = default
+        except Exception as e:
+            print(f"[prefetch] {name} failed, continuing without it: {e}")
+            out[name] = default
+    # Nguồn quá hạn vẫn chạy nốt ở nền; không chờ
+    pool.shutdown(wait=False, cancel_futures=True)
+    return out
+
+class _CollectorState:
+    """Bộ nhớ chống trùng của MỘT nhóm trong MỘT ngày VN (dùng lại giữa các vòng poll ở --serve).
+
+    day: mặc định hôm nay; replay truyền ngày của tin (backdated) để báo cáo cũ không tính vào hôm nay."""
+
+    def __init__(self, chat_id: str | None = None, day=None):
+        self.chat_id         = str(chat_id or (TELEGRAM_CHAT_IDS or [""])[0])
+        self.day             = day or _today_vn()
+        self.backdated       = self.day != _today_vn()
+        chat, t = self.chat_id, PREFETCH_TIMEOUT_SEC
+
+        def captions():
             try:
-                _tg("getUpdates", offset=max_uid + 1, timeout=0)
-            except Exception:
-                pass
+                day_recs = _fetch_day_messages(self.day)
+            except HTTPError:
+                day_recs = None
+            return (_load_today_caption_hashes(chat, day_recs or {}),
+                    _load_caption_index(chat, day_recs, self.day))
+
+        got = _prefetch({
+            "seen_uids":   (_load_seen_uids, set(), t),
+            "captions":    (captions, (set(), None), t),
+            "warned_caps": (lambda: _load_warned_caps_persist(chat, self.day), set(), t),
+            "seen_msgids": (lambda: _load_seen_msgids_persist(chat, self.day), set(), t),
+            "rollup":      (lambda: _load_rollup(self.day, chat, rebuild=False), None, t),
+        })
+        self.seen_uids       = got["seen_uids"]
+        self.seen_caps_day, self.captions = got["captions"]
+        self.warned_caps_day = got["warned_caps"]
+        self.seen_msgids_day = got["seen_msgids"]
+        self.rollup          = got["rollup"]
+        self.warned_session: Set[str] = set()
+        self.status_cache: Dict[str, tuple] = {}   # tham số /status -> (monotonic, rollup_version, text)
+        self.rollup_version = 0
+        self.dirty = False
+        self.rollup_dirty = self.rollup is None
+        if self.rollup is None:
+            try:
+                with _metrics.phase("rollup_from_messages"):
+                    self.rollup = _rollup_from_messages(self.day, self.chat_id)
+            except HTTPError:
+                self.rollup, self.rollup_dirty = {}, False
+
+    def should_warn(self, ch: str) -> bool:
+        return ch not in self.warned_caps_day and ch not in self.warned_session
+
+    def warn(self, ch: str):
+        self.warned_session.add(ch)
+        self.warned_caps_day.add(ch)
+        self.dirty = True
+
+    def mark_seen(self, msg_ids):
+        self.seen_msgids_day.update(msg_ids)
+        self.dirty = True
+
+    def unmark_seen(self, msg_ids):
+        self.seen_msgids_day.difference_update(msg_ids)
+        self.dirty = True
+
+    def accept(self, code: str, content: str, rec, ts: "int | None" = None):
+        """on_done của record Messages: chỉ đưa vào rollup khi đã ghi Airtable thành công.
+
+        ts: giờ gửi (epoch) cho state backdated; mặc định lúc ghi."""
+        if rec is None:
+            return
+        self.rollup[code] = [int(ts or time.time()), _short_text(content)]
+        self.rollup_dirty = True
+        self.rollup_version += 1
+
+    def persist(self, buf: "_WriteBuffer | None" = None):
+        if self.dirty:
+            _save_warned_caps_persist(self.warned_caps_day, buf, self.chat_id, self.day)
+            _save_seen_msgids_persist(self.seen_msgids_day, buf, self.chat_id, self.day)
+            self.dirty = False
+        if self.rollup_dirty:
+            _save_rollup(self.day, self.rollup, buf, self.chat_id)
+            self.rollup_dirty = False
+
+def _handle_report(st: _CollectorState, writes: _WriteBuffer, reply, chat_id: str, rep_id: int,
+                   content: str, photo_ids: List[str], msg_ids, thread_id,
+                   phashes: "Dict[str, int] | None" = None, ts: "int | None" = None):
+    """Phân loại 1 báo cáo (tin lẻ hoặc album đã gộp): sai format / trùng / ghi nhận.
+
+    phashes: dHash các ảnh của báo cáo (chỉ có khi bật PHASH_ENABLE).
+    ts: message["date"]; với state backdated (replay) được ghi vào COL_MSG_TS và rollup."""
+    ch   = _hash_caption(content) if content else ""
+    code = _extract_code(content)
+
+    if not code:
+        if content and st.should_warn(ch):
+            reply(chat_id, rep_id, MSG_BADFMT, thread_id)
+            st.warn(ch)
+        st.mark_seen(msg_ids)
+        return
 
-        # 4) Chuẩn bị bộ nhớ chống trùng trong ngày
-        seen_uids        = _load_seen_uids()
-        seen_caps_day    = _load_today_caption_hashes()
-        warned_caps_day  = _load_warned_caps_persist()
-        seen_msgids_day  = _load_seen_msgids_persist()
-        warned_session: Set[str] = set()
-
-        def should_warn(ch: str) -> bool:
-            return ch not in warned_caps_day and ch not in warned_session
-
-        # 5) Bộ đệm gộp album (thêm thread_id)
-        group_buf: Dict[str, Dict[str, Any]] = {}
-        persist_dirty = False
-
-        # 6) Duyệt & gom theo album
-        for u in updates:
-            msg = u.get("message") or {}
-            frm = msg.get("from", {}) or {}
-            if frm.get("is_bot"):
-                continue
+    near = _near_duplicate_photo(phashes, st.seen_uids)
+    if near is not None:
+        print(f"[phash] chat {chat_id} msg {rep_id}: near-duplicate photo (distance {near})")
+    sim = None
+    if st.captions is not None and ch not in st.seen_caps_day:
+        since = (st.day - datetime.timedelta(days=max(1, CAPSIM_WINDOW_DAYS) - 1)).isoformat()
+        sim = st.captions.best_match(chat_id, content, since)
+        # Cửa sổ so sánh dài hơn phần còn giữ trên Airtable -> tra thêm lịch sử đã gộp
+        hist = _history_filter() if CAPSIM_WINDOW_DAYS > COMPACT_DAYS else None
+        if sim is None and hist is not None and _history_caption_key(chat_id, content) in hist:
+            sim = 1.0
+    if (_is_duplicate_photo(photo_ids, st.seen_uids) or near is not None or sim is not None
+            or ch in st.seen_caps_day or ch in st.warned_caps_day):
+        if content and st.should_warn(ch):
+            text = MSG_DUPIMG if sim is None else f"{MSG_DUPIMG} (caption giống {sim:.0%})"
+            reply(chat_id, rep_id, text, thread_id)
+            st.warn(ch)
+        st.mark_seen(msg_ids)
+        return
 
-            chat = msg.get("chat", {})
-            chat_id = str(chat.get("id", ""))
-            if not chat_id or chat_id != str(TELEGRAM_CHAT_ID):
-                continue
+    fields = {COL_MSG_TEXT: content, COL_MSG_CODE: code}
+    if COL_MSG_CHAT:
+        fields[COL_MSG_CHAT] = chat_id
+    when = ts if st.backdated else None
+    if when:
+        fields[COL_MSG_TS] = datetime.datetime.fromtimestamp(when, VN_TZ).isoformat()
+    # Đánh dấu tạm (chặn bản trùng trong cùng lô); chỉ xác nhận khi record Messages đã ghi xong
+    new_uids = _claim_photo_ids(photo_ids, st.seen_uids)
+    st.seen_caps_day.add(ch)
+    st.mark_seen(msg_ids)
+
+    def done(rec):
+        if rec is None:
+            # Không ghi được -> không báo 🆗, bỏ các dấu tạm để lần gửi lại được xử lý như mới
+            _release_photo_ids(new_uids, st.seen_uids)
+            st.seen_caps_day.discard(ch)
+            st.unmark_seen(msg_ids)
+            return
+        st.accept(code, content, rec, when)
+        _save_photo_ids(code, new_uids, st.seen_uids, writes, phashes)
+        if st.captions is not None:
+            st.captions.add(chat_id, st.day.isoformat(), content)
+        reply(chat_id, rep_id, MSG_OK, thread_id)
+
+    writes.create(TBL_MESSAGES, fields, on_done=done)
+
+# ---- /status [mã]: tình hình trong ngày từ rollup + danh sách nơi (đã có trong RAM, không đọc Messages) ----
+STATUS_CACHE_SEC    = int(os.getenv("STATUS_CACHE_SEC", "60"))   # hỏi lại trong khoảng này -> trả bản đã render
+STATUS_MAX_LIST     = 50                                          # số nơi thiếu liệt kê tối đa trong 1 tin
+STATUS_RE = re.compile(r"^/status(?:@(\w+))?(?:\s+(\S+))?\s*$", re.IGNORECASE)
+
+_bot_user: str = ""
+
+def _bot_username() -> str:
+    """Username của bot (getMe, gọi 1 lần khi gặp /status@...); lỗi thì trả "" và thử lại lần sau."""
+    global _bot_user
+    if not _bot_user:
+        try:
+            _bot_user = str(_tg("getMe")["result"].get("username") or "")
+        except (requests.exceptions.RequestException, KeyError) as e:
+            print(f"[status] getMe failed: {e}")
+    return _bot_user
+
+def _status_for_me(cmd: "re.Match") -> bool:
+    """/status trơn, hoặc /status@<username của bot này>; lệnh gửi cho bot khác thì bỏ qua."""
+    to = cmd.group(1)
+    return not to or to.lower() == _bot_username().lower()
+
+def _render_status(st: _CollectorState, arg: str) -> str:
+    master_codes, name_map = _get_master_codes(st.chat_id)
+    roll = st.rollup or {}
+    if arg:
+        name = name_map.get(arg, "")
+        label = f"{arg} — {name}" if name else arg
+        if arg in roll:
+            ts, txt = roll[arg]
+            at = datetime.datetime.fromtimestamp(ts, VN_TZ).strftime("%H:%M")
+            return f"✅ {label}: đã gửi lúc {at} — “{txt}”"
+        if arg not in name_map:
+            return f"❔ {arg}: không có trong danh sách nơi"
+        return f"❌ {label}: chưa gửi hôm nay"
+    sent = sum(1 for c in master_codes if c in roll)
+    missing = [c for c in master_codes if c not in roll]
+    now = datetime.datetime.now(VN_TZ)
+    lines = [f"📋 Tình hình báo cáo {now.strftime('%d/%m/%Y')} (tới {now.strftime('%H:%M')})",
+             f"✅ Đã gửi {sent}/{len(master_codes)} • ❌ Thiếu {len(missing)}"]
+    if missing:
+        lines.append("Chưa gửi:")
+        lines += [f"• {c} — {name_map[c]}" if name_map.get(c) else f"• {c}" for c in missing[:STATUS_MAX_LIST]]
+        if len(missing) > STATUS_MAX_LIST:
+            lines.append(f"… và {len(missing) - STATUS_MAX_LIST} nơi khác")
+    return "\n".join(lines)
+
+def _status_text(st: _CollectorState, arg: str) -> str:
+    """Bản render của /status; dùng lại trong STATUS_CACHE_SEC nếu rollup chưa đổi."""
+    now = time.monotonic()
+    hit = st.status_cache.get(arg)
+    if hit and now - hit[0] < STATUS_CACHE_SEC and hit[1] == st.rollup_version:
+        return hit[2]
+    text = _render_status(st, arg)
+    st.status_cache[arg] = (now, st.rollup_version, text)
+    return text
+
+def _process_updates(updates: List[Dict[str, Any]], st: _CollectorState, writes: _WriteBuffer,
+                     reply=_send_reply):
+    """Bước 5–7 của collector: lọc, gộp album theo media_group_id, dedup, reply.
+
+    reply(chat_id, reply_to_message_id, text, thread_id): mặc định gửi ngay; collector
+    truyền _ReplyDispatcher.put để gửi nền."""
+    # 5) Bộ đệm gộp album (thêm thread_id); dHash ảnh cả lô tính song song trước
+    group_buf: Dict[str, Dict[str, Any]] = {}
+    statuses: List[tuple] = []
+    phashes = _photo_phashes(updates, st)
+
+    # 6) Duyệt & gom theo album
+    for u in updates:
+        msg = u.get("message") or {}
+        frm = msg.get("from", {}) or {}
+        if frm.get("is_bot"):
+            continue
 
-            message_id = int(msg.get("message_id"))
-            if message_id in seen_msgids_day:
-                continue
+        chat = msg.get("chat", {})
+        chat_id = str(chat.get("id", ""))
+        if not chat_id or chat_id != st.chat_id:
+            continue
 
-            text = msg.get("text", "")
-            caption = msg.get("caption", "")
-            photos = msg.get("photo", [])
-            media_group_id = msg.get("media_group_id")
-            thread_id = msg.get("message_thread_id")  # <<=== forum topic id nếu có
-            content = caption if caption else text
-
-            if media_group_id:
-                g = group_buf.get(media_group_id)
-                if not g:
-                    g = {
-                        "chat_id": chat_id,
-                        "rep_msg_id": message_id,
-                        "caption": None,
-                        "photo_ids": set(),
-                        "msg_ids": set(),
-                        "thread_id": thread_id,
-                    }
-                    group_buf[media_group_id] = g
-                g["photo_ids"].update(_photo_unique_ids(photos))
-                g["msg_ids"].add(message_id)
-                if content:
-                    g["caption"] = content
-                    g["rep_msg_id"] = message_id
-                if g.get("thread_id") is None and thread_id is not None:
-                    g["thread_id"] = thread_id
-                continue
+        message_id = int(msg.get("message_id"))
+        if message_id in st.seen_msgids_day:
+            continue
 
-            # ---- Message lẻ ----
-            ch   = _hash_caption(content) if content else ""
-            code = _extract_code(content)
-
-            if not code:
-                if content and should_warn(ch):
-                    _send_reply(chat_id, message_id, MSG_BADFMT, thread_id=thread_id)
-                    warned_session.add(ch)
-                    warned_caps_day.add(ch)
-                    persist_dirty = True
-                seen_msgids_day.add(message_id); persist_dirty = True
-                continue
+        text = msg.get("text", "")
+        caption = msg.get("caption", "")
+        photos = msg.get("photo", [])
+        media_group_id = msg.get("media_group_id")
+        thread_id = msg.get("message_thread_id")  # <<=== forum topic id nếu có
+        content = caption if caption else text
+        small_uid = (_smallest_photo(photos) or {}).get("file_unique_id")
+        ph = {small_uid: phashes[small_uid]} if small_uid in phashes else {}
+
+        if media_group_id:
+            g = group_buf.get(media_group_id)
+            if not g:
+                g = {
+                    "chat_id": chat_id,
+                    "rep_msg_id": message_id,
+                    "caption": None,
+                    "photo_ids": set(),
+                    "msg_ids": set(),
+                    "thread_id": thread_id,
+                    "phashes": {},
+                    "date": msg.get("date"),
+                }
+                group_buf[media_group_id] = g
+            g["photo_ids"].update(_photo_unique_ids(photos))
+            g["msg_ids"].add(message_id)
+            g["phashes"].update(ph)
+            if content:
+                g["caption"] = content
+                g["rep_msg_id"] = message_id
+            if g.get("thread_id") is None and thread_id is not None:
+                g["thread_id"] = thread_id
+            continue
 
-            photo_ids = _photo_unique_ids(photos)
-            if _is_duplicate_photo(photo_ids, seen_uids) or ch in seen_caps_day or ch in warned_caps_day:
-                if content and should_warn(ch):
-                    _send_reply(chat_id, message_id, MSG_DUPIMG, thread_id=thread_id)
-                    warned_session.add(ch)
-                    warned_caps_day.add(ch)
-                    persist_dirty = True
-                seen_msgids_day.add(message_id); persist_dirty = True
-                continue
+        # ---- Lệnh /status ----
+        cmd = STATUS_RE.match(text.strip()) if text and not photos else None
+        if cmd:
+            if _status_for_me(cmd):
+                statuses.append((chat_id, message_id, cmd.group(2) or "", thread_id))
+            st.mark_seen([message_id])
+            continue
 
-            _air_table(TBL_MESSAGES).create({COL_MSG_TEXT: content, COL_MSG_CODE: code})
-            _save_photo_ids(code, photo_ids, seen_uids)
-            seen_caps_day.add(ch)
-            _send_reply(chat_id, message_id, MSG_OK, thread_id=thread_id)
-            seen_msgids_day.add(message_id); persist_dirty = True
-
-        # 7) Xử lý album đã gom
-        for mgid, g in group_buf.items():
-            chat_id   = g["chat_id"]
-            rep_id    = g["rep_msg_id"]
-            content   = g["caption"] or ""
-            photo_ids = list(g["photo_ids"])
-            msg_ids   = g["msg_ids"]
-            thread_id = g.get("thread_id")
-
-            if msg_ids and all(mid in seen_msgids_day for mid in msg_ids):
-                continue
+        # ---- Message lẻ ----
+        _handle_report(st, writes, reply, chat_id, message_id, content, _photo_unique_ids(photos),
+                       [message_id], thread_id, ph, msg.get("date"))
 
-            ch   = _hash_caption(content) if content else ""
-            code = _extract_code(content)
+    # 7) Xử lý album đã gộp
+    for mgid, g in group_buf.items():
+        msg_ids = g["msg_ids"]
+        if msg_ids and all(mid in st.seen_msgids_day for mid in msg_ids):
+            continue
+        _handle_report(st, writes, reply, g["chat_id"], g["rep_msg_id"], g["caption"] or "",
+                       list(g["photo_ids"]), msg_ids, g.get("thread_id"), g["phashes"], g.get("date"))
+
+    # /status trả lời sau cùng: flush ghi của lô trước để rollup tính cả báo cáo vừa nhận
+    if statuses:
+        writes.flush()
+        for chat_id, message_id, arg, thread_id in statuses:
+            reply(chat_id, message_id, _status_text(st, arg), thread_id)
+
+def _partition_by_chat(updates: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Chia update theo nhóm (giữ thứ tự); chỉ giữ các nhóm được cấu hình trong TELEGRAM_CHAT_IDS."""
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    for u in updates:
+        chat_id = _update_chat(u)
+        if chat_id in TELEGRAM_CHAT_IDS:
+            out.setdefault(chat_id, []).append(u)
+    return out
 
-            if not code:
-                if content and should_warn(ch):
-                    _send_reply(chat_id, rep_id, MSG_BADFMT, thread_id=thread_id)
-                    warned_session.add(ch)
-                    warned_caps_day.add(ch)
-                    persist_dirty = True
-                seen_msgids_day.update(msg_ids); persist_dirty = True
-                continue
+def _update_chat(u: Dict[str, Any]) -> str:
+    return str(((u.get("message") or {}).get("chat") or {}).get("id", ""))
+
+def _cut_at_unleased(updates: List[Dict[str, Any]], leased) -> tuple:
+    """(phần trước update đầu tiên của nhóm không giữ lease, phần từ update đó trở đi)."""
+    for i, u in enumerate(updates):
+        chat_id = _update_chat(u)
+        if chat_id in TELEGRAM_CHAT_IDS and chat_id not in leased:
+            return updates[:i], updates[i:]
+    return updates, []
+
+def _max_update_id(updates: List[Dict[str, Any]]):
+    max_uid = None
+    for u in updates:
+        uid = u.get("update_id")
+        if isinstance(uid, int):
+            max_uid = uid if max_uid is None else max(max_uid, uid)
+    return max_uid
+
+def _min_update_id(updates: List[Dict[str, Any]]):
+    ids = [u["update_id"] for u in updates if isinstance(u.get("update_id"), int)]
+    return min(ids) if ids else None
+
+def _album_id(u: Dict[str, Any]):
+    return (u.get("message") or {}).get("media_group_id")
+
+def _split_trailing_album(updates: List[Dict[str, Any]], hold_whole: bool = False):
+    """Tách các phần album nằm ở CUỐI trang (có thể còn phần ở trang sau): (xử lý ngay, để lại).
+
+    Nếu cả trang là một album thì chỉ để lại khi hold_whole=True."""
+    if not updates:
+        return updates, []
+    mg = _album_id(updates[-1])
+    if not mg:
+        return updates, []
+    i = len(updates)
+    while i > 0 and _album_id(updates[i - 1]) == mg:
+        i -= 1
+    if i == 0 and not hold_whole:
+        return updates, []   # cả trang là một album -> xử lý luôn
+    return updates[:i], updates[i:]
+
+COLLECT_BUDGET_SEC  = int(os.getenv("COLLECT_BUDGET_SEC", "120"))   # < TTL lock (180s)
+COLLECT_LOCK_TTL    = 180
+GETUPDATES_LIMIT    = 100
+
+class _ChatWorker:
+    """Xử lý update của MỘT nhóm trong thread riêng; lần chạy đã giữ lease của nhóm đó.
+
+    Nhận từng chunk qua submit(), wait_idle() chờ xử lý + flush xong các chunk đã nhận;
+    close() báo hết việc và chờ worker lưu state, flush ghi, gửi nốt reply rồi nhả lease."""
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.q: "queue.Queue" = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"chat-{chat_id}", daemon=True)
+        self.thread.start()
+
+    def submit(self, updates: List[Dict[str, Any]]):
+        self.q.put(updates)
+
+    def wait_idle(self):
+        self.q.join()
+
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
+
+    def _drop_all(self) -> int:
+        dropped = 0
+        while True:
+            ups = self.q.get()
+            self.q.task_done()
+            if ups is None:
+                return dropped
+            dropped += len(ups)
+
+    def _run(self):
+        import traceback
+        writes = _WriteBuffer()
+        replies = None
+        st = None
+        renewed = time.monotonic()
+        try:
+            # 4) Bộ nhớ chống trùng trong ngày của nhóm (các nguồn nạp song song) + hàng đợi reply
+            with _metrics.phase("4_load_state"):
+                st = _CollectorState(self.chat_id)
+            replies = _ReplyDispatcher()
+            while True:
+                ups = self.q.get()
+                try:
+                    if ups is None:
+                        break
+                    # 5–7) Lọc, gộp album, dedup, reply (gửi nền) — rồi flush ngay phần ghi của chunk
+                    with _metrics.phase("5_7_process"):
+                        _process_updates(ups, st, writes, replies.put)
+                        if time.monotonic() - renewed >= COLLECT_LOCK_TTL / 3:
+                            _meta_set(_lock_key(self.chat_id), str(int(time.time())), writes)
+                            renewed = time.monotonic()
+                        failed = writes.flush()
+                    if failed:
+                        print(f"[airtable] chat {self.chat_id}: {len(failed)} record(s) failed to write")
+                finally:
+                    self.q.task_done()
+        except Exception:
+            traceback.print_exc()
+            self._drop_all()
+        finally:
+            # 8) Flush phần ghi còn lại rồi lưu các set persist + rollup trong ngày (kể cả khi lỗi
+            #    giữa chừng: các báo cáo đã ghi + 🆗 phải có trong rollup)
+            start = len(writes.failures)
+            with _metrics.phase("8_persist"):
+                writes.flush()
+                if st is not None:
+                    st.persist(writes)
+            # 9) Flush ghi theo lô, gửi nốt reply rồi mới nhả lease
+            with _metrics.phase("9_flush_release"):
+                writes.flush()
+                failed = writes.failures[start:]
+                if failed:
+                    print(f"[airtable] chat {self.chat_id}: {len(failed)} record(s) failed to write")
+                if replies is not None:
+                    replies.close()
+                _release_lock(chat_id=self.chat_id)
+
+def collect_once(budget_sec: int = COLLECT_BUDGET_SEC):
+    """Một lần chạy cron cho mọi nhóm trong TELEGRAM_CHAT_IDS.
+
+    Rút hết hàng đợi getUpdates theo từng trang 100 update (drain): mỗi trang ACK + ghi
+    last_update_id trước (lời gọi ACK lấy luôn trang kế), rồi chia update theo nhóm và đẩy
+    cho worker của nhóm đó xử lý song song. Trang sau chỉ được ACK khi các worker đã xử lý +
+    ghi xong trang trước, nên budget_sec tính cả phần xử lý. Dừng khi hàng đợi rỗng hoặc hết
+    budget_sec; phần còn lại chưa ACK nên lần chạy sau sẽ nhận. Album bị cắt ở cuối một trang
+    đầy được để lại cho trang sau để gộp đủ các phần.
+
+    Mỗi nhóm có lease riêng (lock_collector[@chat]). Việc đầu tiên là đọc riêng các key lock:
+    nếu mọi lease đều đang bị giữ (đang chạy --serve/--webhook) thì thoát ngay mà không gọi
+    getUpdates (gọi sẽ cắt long-poll của serve, hoặc 409 khi đã đặt webhook). Sau đó một
+    getUpdates (không offset) dò hàng đợi: rỗng thì kết thúc mà chưa nạp Meta/offset/bộ chống
+    trùng. Gặp update của nhóm có lease do lần chạy khác giữ thì chỉ ACK tới trước update đó
+    (chờ lease tối đa LEASE_WAIT_SEC, rồi dừng)."""
+    chats = list(TELEGRAM_CHAT_IDS)
+    # 0) Lease của serve/webhook đang giữ mọi nhóm: không đụng tới getUpdates
+    with _metrics.phase("0_check_leases"):
+        if _leases_all_held(chats, COLLECT_LOCK_TTL):
+            print("[collect] collector lease is held by another run")
+            return
+    # Dò nhanh (không offset = các update chưa ACK): rỗng thì thoát, chưa nạp snapshot Meta,
+    # offset hay bộ chống trùng
+    with _metrics.phase("0_probe"):
+        probe = _tg("getUpdates", timeout=0, limit=GETUPDATES_LIMIT,
+                    allowed_updates=["message"]).get("result", [])
+    if not probe:
+        return
+    with _metrics.phase("0_acquire_leases"):
+        leased = _acquire_leases(chats, COLLECT_LOCK_TTL)
+    if not leased:
+        return
+    with _metrics.phase("0_prune_meta"):
+        try:
+            _prune_meta_days()
+        except HTTPError as e:
+            print(f"[meta] prune failed: {e}")
+    started = time.monotonic()
+    workers: Dict[str, _ChatWorker] = {}
+    try:
+        # 1) Đọc offset hiện tại
+        with _metrics.phase("1_read_offset"):
+            offset = _meta_get("last_update_id")
+            offset = int(offset) + 1 if offset else None
+
+        # 2) Trang đầu = kết quả dò; nếu còn update cũ hơn offset (ACK lần trước chưa tới Telegram)
+        #    thì kéo lại kể từ offset
+        page = probe
+        if offset is not None and (_min_update_id(page) or 0) < offset:
+            with _metrics.phase("2_get_updates"):
+                page = _tg("getUpdates", timeout=0, allowed_updates=["message"], offset=offset,
+                           limit=GETUPDATES_LIMIT).get("result", [])
+
+        while page:
+            chunk, held = _split_trailing_album(page) if len(page) >= GETUPDATES_LIMIT else (page, [])
+            # Không ACK update của nhóm mà lần chạy này không giữ lease (ACK rồi thì không ai xử lý)
+            chunk, blocked = _cut_at_unleased(chunk, leased)
+            if blocked and not chunk:
+                chat_id = _update_chat(blocked[0])
+                left = max(0, budget_sec - int(time.monotonic() - started))
+                with _metrics.phase("0_acquire_leases"):
+                    if _wait_lease(chat_id, COLLECT_LOCK_TTL, min(LEASE_WAIT_SEC, left)):
+                        leased.add(chat_id)
+                        continue
+                print(f"[collect] chat {chat_id}: lease busy, leaving update {blocked[0].get('update_id')} "
+                      "and later ones unacknowledged")
+                break
+            if blocked:
+                chunk, _ = _split_trailing_album(chunk)   # album có thể còn phần sau điểm cắt
+
+            max_uid = _max_update_id(chunk)
+            if max_uid is None:
+                break
+            # 4) Tạo worker cho nhóm mới trước khi ACK: worker nạp state (bước 4) song song với ACK
+            parts = _partition_by_chat(chunk)
+            for chat_id in parts:
+                if chat_id not in workers:
+                    workers[chat_id] = _ChatWorker(chat_id)
+
+            # 3) ACK TRƯỚC: đẩy offset lên max+1 của chunk; lời gọi ACK trả về luôn trang kế
+            offset = max_uid + 1
+            with _metrics.phase("3_ack"):
+                _meta_set("last_update_id", str(max_uid))
+                try:
+                    nxt = _tg("getUpdates", offset=offset, timeout=0, allowed_updates=["message"],
+                              limit=GETUPDATES_LIMIT).get("result", [])
+                except Exception:
+                    nxt = []
+
+            # 5–9) Mỗi nhóm một worker (thread + lease riêng); chờ xử lý xong chunk rồi mới ACK chunk sau
+            for chat_id, ups in parts.items():
+                workers[chat_id].submit(ups)
+            with _metrics.phase("4_9_chunk_wait"):
+                for w in workers.values():
+                    w.wait_idle()
+
+            if budget_sec <= 0 or time.monotonic() - started >= budget_sec:
+                if nxt:
+                    print("[collect] time budget reached, leaving backlog for next run")
+                break
+            page = nxt
 
-            if _is_duplicate_photo(photo_ids, seen_uids) or ch in seen_caps_day or ch in warned_caps_day:
-                if content and should_warn(ch):
-                    _send_reply(chat_id, rep_id, MSG_DUPIMG, thread_id=thread_id)
-                    warned_session.add(ch)
-                    warned_caps_day.add(ch)
-                    persist_dirty = True
-                seen_msgids_day.update(msg_ids); persist_dirty = True
-                continue
+    finally:
+        with _metrics.phase("4_9_workers_wait"):
+            for w in workers.values():
+                w.close()
+        # Nhả lease của các nhóm không có update nào (1 lần ghi theo lô)
+        _release_leases([c for c in leased if c not in workers])
+
+# ===== Serve (--serve) — chạy liên tục, long-poll getUpdates =====
+SERVE_POLL_TIMEOUT  = int(os.getenv("SERVE_POLL_TIMEOUT", "50"))    # giây long-poll mỗi getUpdates
+SERVE_PERSIST_SEC   = int(os.getenv("SERVE_PERSIST_SEC", "60"))     # chu kỳ ghi state/offset về Airtable
+SERVE_LOCK_TTL      = 180
+
+def serve_forever():
+    """Giữ lease của mọi nhóm (gia hạn định kỳ) và xử lý update ngay khi tới.
+
+    Bộ nhớ chống trùng mỗi nhóm nằm trong RAM, chỉ nạp lại khi sang ngày VN mới; state trong
+    ngày, offset và lease được ghi về Meta mỗi SERVE_PERSIST_SEC giây. Khi đang serve, các
+    lần chạy --collect theo cron sẽ thấy lease còn hạn và bỏ qua."""
+    import signal
+    chats = list(TELEGRAM_CHAT_IDS)
+    if not _acquire_all_leases(chats, SERVE_LOCK_TTL):
+        print("[serve] collector lease is held by another run")
+        return
+
+    def _stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _stop)
+
+    offset = _meta_get("last_update_id")
+    offset = int(offset) + 1 if offset else None
+    saved_offset = offset
+    states = {c: _CollectorState(c) for c in chats}
+    writes = _WriteBuffer()
+    replies = _ReplyDispatcher()
+    last_persist = time.monotonic()
+    hold_mg = None   # album ở cuối lần poll trước, đang chờ thêm các phần còn lại
+
+    def persist():
+        nonlocal saved_offset, last_persist
+        for st in states.values():
+            st.persist(writes)
+        if offset is not None and offset != saved_offset:
+            _meta_set("last_update_id", str(offset - 1), writes)
+            saved_offset = offset
+        now = str(int(time.time()))
+        for chat_id in chats:
+            _meta_set(_lock_key(chat_id), now, writes)   # gia hạn lease
+        failed = writes.flush()
+        if failed:
+            print(f"[airtable] {len(failed)} record(s) failed to write")
+        last_persist = time.monotonic()
+
+    print(f"[serve] polling getUpdates for {len(chats)} chat(s) (timeout={SERVE_POLL_TIMEOUT}s)")
+    try:
+        while True:
+            if _today_vn() != next(iter(states.values())).day:
+                persist()
+                states = {c: _CollectorState(c) for c in chats}
+                try:
+                    _prune_meta_days()
+                except HTTPError as e:
+                    print(f"[meta] prune failed: {e}")
+
+            try:
+                resp = _tg("getUpdates", timeout=1 if hold_mg else SERVE_POLL_TIMEOUT,
+                           allowed_updates=["message"], offset=offset)
+            except requests.exceptions.RequestException as e:
+                print(f"[serve] getUpdates failed: {e}")
+                time.sleep(5)
+                resp = {}
+            updates = resp.get("result", [])
+
+            # Các phần album tới rời rạc giữa các lần poll: chờ thêm 1 lần poll ngắn rồi mới xử lý
+            ready, held = _split_trailing_album(updates, hold_whole=True)
+            if held and _album_id(held[0]) != hold_mg:
+                hold_mg = _album_id(held[0])
+                updates = ready
+            else:
+                hold_mg = None
+
+            max_uid = _max_update_id(updates)
+            if max_uid is not None:
+                # offset của lần poll kế tiếp chính là ACK cho lô này
+                offset = max_uid + 1
+                for chat_id, ups in _partition_by_chat(updates).items():
+                    _process_updates(ups, states[chat_id], writes, replies.put)
+                # Ghi ngay báo cáo vừa nhận: 🆗 chỉ gửi sau khi record Messages đã ghi xong
+                failed = writes.flush()
+                if failed:
+                    print(f"[airtable] {len(failed)} record(s) failed to write")
+
+            if time.monotonic() - last_persist >= SERVE_PERSIST_SEC:
+                persist()
+    finally:
+        persist()
+        replies.close()
+        _release_leases(chats)
+
+# ===== Webhook (--webhook) — Telegram POST update tới server local =====
+WEBHOOK_HOST        = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT        = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH        = os.getenv("WEBHOOK_PATH", "/telegram-webhook")
+WEBHOOK_SECRET      = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_URL         = os.getenv("WEBHOOK_URL", "")                  # nếu có: gọi setWebhook khi khởi động
+WEBHOOK_QUEUE_MAX   = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))
+WEBHOOK_WORKERS     = int(os.getenv("WEBHOOK_WORKERS", "4"))
+ALBUM_WINDOW_SEC    = float(os.getenv("ALBUM_WINDOW_SEC", "1.5"))   # chờ thêm phần album sau phần cuối cùng
+
+class _WebhookIngest:
+    """Nhận update từ HTTP thread, gộp album theo cửa sổ thời gian, worker pool xử lý.
+
+    Update lẻ vào hàng đợi (có giới hạn) ngay; các phần album (cùng media_group_id) được giữ
+    tới khi không có phần mới trong ALBUM_WINDOW_SEC rồi mới vào hàng đợi thành một lô.
+    Worker dùng đúng _process_updates của collector; state mỗi nhóm có lock riêng nên các
+    nhóm khác nhau xử lý song song."""
+
+    def __init__(self, chats: List[str], workers: int = WEBHOOK_WORKERS,
+                 queue_max: int = WEBHOOK_QUEUE_MAX, album_window: float = ALBUM_WINDOW_SEC):
+        self.chats = chats
+        self.q: "queue.Queue" = queue.Queue(maxsize=queue_max)
+        self.album_window = album_window
+        self.albums: Dict[str, Dict[str, Any]] = {}   # media_group_id -> {"updates": [...], "due": t}
+        self.album_lock = threading.Lock()
+        self.states = {c: _CollectorState(c) for c in chats}
+        self.chat_locks = {c: threading.Lock() for c in chats}
+        self.writes = {c: _WriteBuffer() for c in chats}
+        self.replies = _ReplyDispatcher()
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self._work, name=f"webhook-{i}", daemon=True)
+                        for i in range(max(1, workers))]
+        self.threads.append(threading.Thread(target=self._album_loop, name="webhook-albums", daemon=True))
+        for t in self.threads:
+            t.start()
+
+    def offer(self, update: Dict[str, Any]) -> bool:
+        """Gọi từ HTTP thread; False nếu hàng đợi đầy (trả 503 để Telegram gửi lại sau)."""
+        chat_id = str(((update.get("message") or {}).get("chat") or {}).get("id", ""))
+        if chat_id not in self.states:
+            return True
+        mg = _album_id(update)
+        if mg:
+            with self.album_lock:
+                if mg not in self.albums and len(self.albums) >= self.q.maxsize:
+                    return False
+                g = self.albums.setdefault(mg, {"updates": []})
+                g["updates"].append(update)
+                g["due"] = time.monotonic() + self.album_window
+            return True
+        try:
+            self.q.put_nowait([update])
+        except queue.Full:
+            return False
+        return True
+
+    def _album_loop(self):
+        while not self.stopping.is_set():
+            self._flush_albums(force=False)
+            time.sleep(0.1)
+
+    def _flush_albums(self, force: bool):
+        now = time.monotonic()
+        with self.album_lock:
+            ready = [mg for mg, g in self.albums.items() if force or g["due"] <= now]
+            batches = [self.albums.pop(mg)["updates"] for mg in ready]
+        for ups in batches:
+            ups.sort(key=lambda u: u.get("update_id", 0))
+            self.q.put(ups)   # chờ nếu hàng đợi đầy: phần album đã nhận, không được bỏ
+
+    def _work(self):
+        import traceback
+        while True:
+            ups = self.q.get()
+            try:
+                if ups is None:
+                    return
+                chat_id = str(ups[0]["message"]["chat"]["id"])
+                with self.chat_locks[chat_id]:
+                    _process_updates(ups, self.states[chat_id], self.writes[chat_id], self.replies.put)
+                    failed = self.writes[chat_id].flush()
+                if failed:
+                    print(f"[airtable] chat {chat_id}: {len(failed)} record(s) failed to write")
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.q.task_done()
+
+    def persist(self, renew_leases: bool = True):
+        """Lưu state trong ngày + gia hạn lease; sang ngày VN mới thì nạp lại state."""
+        buf = _WriteBuffer()
+        new_day = False
+        for c in self.chats:
+            with self.chat_locks[c]:
+                st = self.states[c]
+                st.persist(buf)
+                if st.day != _today_vn():
+                    self.states[c] = _CollectorState(c)
+                    new_day = True
+            if renew_leases:
+                _meta_set(_lock_key(c), str(int(time.time())), buf)
+        failed = buf.flush()
+        if failed:
+            print(f"[airtable] {len(failed)} record(s) failed to write")
+        if new_day:
+            try:
+                _prune_meta_days()
+            except HTTPError as e:
+                print(f"[meta] prune failed: {e}")
+
+    def close(self):
+        """Đẩy nốt album đang chờ, chờ worker xử lý hết hàng đợi rồi lưu state."""
+        self.stopping.set()
+        self.threads[-1].join()
+        self._flush_albums(force=True)
+        self.q.join()
+        for _ in self.threads[:-1]:
+            self.q.put(None)
+        for t in self.threads[:-1]:
+            t.join()
+        self.persist(renew_leases=False)
+        self.replies.close()
+
+def _make_webhook_server(ingest: _WebhookIngest, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                         secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH):
+    import hmac
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path.split("?", 1)[0] != path:
+                return self._reply(404)
+            got = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(got.encode("utf-8"), secret.encode("utf-8")):
+                return self._reply(401)
+            try:
+                n = int(self.headers.get("Content-Length") or 0)
+                update = json.loads(self.rfile.read(n) or b"{}")
+            except ValueError:
+                return self._reply(400)
+            if not isinstance(update, dict):
+                return self._reply(400)
+            self._reply(200 if ingest.offer(update) else 503)
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    return httpd
+
+def run_webhook():
+    """Chạy server webhook: giữ lease mọi nhóm như --serve, lưu state mỗi SERVE_PERSIST_SEC.
+
+    Khi Telegram đã setWebhook thì getUpdates không dùng được -> tắt cron --collect."""
+    import signal
+    if not WEBHOOK_SECRET:
+        raise SystemExit("WEBHOOK_SECRET is required for --webhook")
+    chats = list(TELEGRAM_CHAT_IDS)
+    if not _acquire_all_leases(chats, SERVE_LOCK_TTL):
+        print("[webhook] collector lease is held by another run")
+        return
+    if WEBHOOK_URL:
+        _tg("setWebhook", url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=["message"])
+
+    ingest = _WebhookIngest(chats)
+    httpd = _make_webhook_server(ingest)
+    stop = threading.Event()
 
-            _air_table(TBL_MESSAGES).create({COL_MSG_TEXT: content, COL_MSG_CODE: code})
-            _save_photo_ids(code, photo_ids, seen_uids)
-            seen_caps_day.add(ch)
-            _send_reply(chat_id, rep_id, MSG_OK, thread_id=thread_id)
-            seen_msgids_day.update(msg_ids); persist_dirty = True
+    def housekeeping():
+        while not stop.wait(SERVE_PERSIST_SEC):
+            ingest.persist()
+    keeper = threading.Thread(target=housekeeping, name="webhook-persist", daemon=True)
+    keeper.start()
+
+    def _stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _stop)
+
+    print(f"[webhook] listening on {WEBHOOK_HOST}:{httpd.server_address[1]}{WEBHOOK_PATH}")
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        stop.set()
+        keeper.join()
+        ingest.close()
+        _release_leases(chats)
+
+# ===== Replay (--replay) — nạp lại update từ file JSONL (sau sự cố / nhóm mới có lịch sử) =====
+REPLAY_BATCH        = int(os.getenv("REPLAY_BATCH", "500"))        # số update mỗi lô (flush + checkpoint)
+
+def _replay_checkpoint_name(path: str) -> str:
+    return f"replay_{hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]}.json"
+
+def _read_update_batches(path: str, start: int = 0, batch: int = REPLAY_BATCH):
+    """Đọc tuần tự từ byte `start`, sinh (updates, byte offset ngay sau update cuối của lô).
+
+    Mỗi dòng là một Update (hoặc một Message trần). Album nằm cuối lô được giữ lại sang lô sau
+    để gộp đủ phần; bộ nhớ chỉ giữ tối đa ~1 lô."""
+    cur: List[tuple] = []
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            pos += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            u = json.loads(line)
+            if "message" not in u and "message_id" in u:
+                u = {"message": u}
+            cur.append((u, pos))
+            if len(cur) >= batch:
+                chunk, _ = _split_trailing_album([x for x, _ in cur])
+                yield chunk, cur[len(chunk) - 1][1]
+                cur = cur[len(chunk):]
+    if cur:
+        yield [x for x, _ in cur], cur[-1][1]
+
+def _partition_by_day(updates: List[Dict[str, Any]]) -> Dict[Any, List[Dict[str, Any]]]:
+    """Chia update theo ngày gửi (giờ VN, giữ thứ tự); thiếu date thì tính hôm nay."""
+    out: Dict[Any, List[Dict[str, Any]]] = {}
+    for u in updates:
+        ts = (u.get("message") or {}).get("date")
+        day = datetime.datetime.fromtimestamp(ts, VN_TZ).date() if ts else _today_vn()
+        out.setdefault(day, []).append(u)
+    return out
 
-        # 8) Lưu lại các set persist trong ngày
-        if persist_dirty:
-            _save_warned_caps_persist(warned_caps_day)
-            _save_seen_msgids_persist(seen_msgids_day)
+def run_replay(path: str, send_replies: bool = False, restart: bool = False):
+    """Chạy file update qua đúng luồng phân loại/gộp album/chống trùng của collector.
+
+    Bộ chống trùng mỗi nhóm nạp 1 lần; ghi Airtable theo lô; mặc định không gửi reply.
+    Sau mỗi lô: flush, lưu state trong ngày + gia hạn lease, ghi checkpoint (byte offset) vào
+    STATE_DIR — chạy lại cùng file sẽ tiếp tục từ đó (--restart để đọc lại từ đầu). Tin đã
+    xử lý (message_id) được bỏ qua nên chạy lại một lô cũng không ghi trùng.
+    Tin được xử lý theo ngày gửi (message["date"], giờ VN): mỗi (nhóm, ngày) một state, tin
+    ngày cũ ghi giờ gửi vào COL_MSG_TS và rollup của đúng ngày đó, không tính vào hôm nay."""
+    chats = list(TELEGRAM_CHAT_IDS)
+    if not _acquire_all_leases(chats, COLLECT_LOCK_TTL):
+        print("[replay] collector lease is held by another run")
+        return
 
+    ck_name = _replay_checkpoint_name(path)
+    ck = {} if restart else (_load_json_state(ck_name) or {})
+    start = int(ck.get("offset") or 0)
+    size = os.path.getsize(path)
+    if start:
+        print(f"[replay] resuming {path} at byte {start}/{size}")
+    states: Dict[tuple, _CollectorState] = {}   # (chat_id, ngày VN) -> state
+    writes = _WriteBuffer()
+    replies = _ReplyDispatcher() if send_replies else None
+    reply = replies.put if replies is not None else (lambda *a: None)
+    done, failed_total = int(ck.get("updates") or 0), 0
+    base_recorded = recorded = int(ck.get("recorded") or 0)
+    t0 = time.monotonic()
+    n = 0
+    try:
+        for ups, pos in _read_update_batches(path, start):
+            for chat_id, part in _partition_by_chat(ups).items():
+                for day, day_part in _partition_by_day(part).items():
+                    st = states.get((chat_id, day))
+                    if st is None:
+                        st = states[(chat_id, day)] = _CollectorState(chat_id, day)
+                    _process_updates(day_part, st, writes, reply)
+            failed_total += len(writes.flush())
+            # rollup_version tăng 1 cho mỗi record Messages đã ghi thành công
+            recorded = base_recorded + sum(st.rollup_version for st in states.values())
+
+            buf = _WriteBuffer()
+            for st in states.values():
+                st.persist(buf)
+            for chat_id in chats:
+                _meta_set(_lock_key(chat_id), str(int(time.time())), buf)
+            buf.flush()
+
+            n += len(ups)
+            done += len(ups)
+            _save_json_state(ck_name, {"path": os.path.abspath(path), "offset": pos,
+                                       "updates": done, "recorded": recorded})
+            rate = n / max(time.monotonic() - t0, 1e-6)
+            print(f"[replay] {done} update(s), {recorded} report(s) recorded, "
+                  f"{pos * 100 // max(size, 1)}% of file, {rate:.0f} upd/s")
     finally:
-        _release_lock()
+        if replies is not None:
+            dropped = replies.close()
+            if dropped:
+                print(f"[replay] {dropped} reply(s) not sent")
+        _release_leases(chats)
+    if failed_total:
+        print(f"[airtable] {failed_total} record(s) failed to write")
+    print(f"[replay] done: {n} update(s) this run in {time.monotonic() - t0:.1f}s")
 
 # ===== Daily report (21h) =====
-def _get_master_codes():
-    tbl = _air_table(TBL_META)
-    recs = tbl.all(fields=[COL_META_CODE, COL_META_NAME])
-    codes, name_map = [], {}
-    for r in recs:
-        f = r.get("fields", {})
-        code = str(f.get(COL_META_CODE, "")).strip()
-        if code and CODE8_RE.fullmatch(code):
-            codes.append(code)
-            name_map[code] = str(f.get(COL_META_NAME, "")).strip()
-    return codes, name_map
-
-def _get_today_messages():
-    tbl = _air_table(TBL_MESSAGES)
-    recs = tbl.all()
-    today = _today_vn()
-    items = []
-    for r in recs:
-        f = r.get("fields", {})
-        text = str(f.get(COL_MSG_TEXT, "")).strip()
-        code = str(f.get(COL_MSG_CODE, "")).strip()
-        ts   = f.get(COL_MSG_TS) or r.get("createdTime")
-        ts_dt = _iso_local(ts) if isinstance(ts, str) else ts
-        if not code or not ts_dt:
-            if not code and text:
-                m = CODE_RE.match(text)
-                if m:
-                    code = m.group(1)
-                    ts_dt = _iso_local(str(ts)) if ts else None
-                else:
-                    continue
-        if not ts_dt:
-            continue
-        if ts_dt.astimezone(VN_TZ).date() == today:
-            items.append({"code": code, "text": text, "ts": ts_dt})
-    return items
-
-def _pick_latest_per_code(items):
-    latest = {}
-    for it in items:
-        c = it["code"]
-        if c not in latest or it["ts"] > latest[c]["ts"]:
-            latest[c] = it
-    return [latest[c] for c in sorted(latest.keys())]
-
-def run_daily_report():
+def _get_master_codes(chat_id: str | None = None):
+    return _meta().master_codes(chat_id)
+
+def _report_chats() -> List[str]:
+    """Nhóm nhận báo cáo 21h: mọi nhóm nếu Messages có cột chat, ngược lại chỉ nhóm chính."""
+    chats = TELEGRAM_CHAT_IDS or [TELEGRAM_CHAT_ID]
+    return list(chats) if COL_MSG_CHAT else chats[:1]
+
+def run_daily_report(chat_id: str | None = None):
+    chat_id = chat_id or (TELEGRAM_CHAT_IDS or [TELEGRAM_CHAT_ID])[0]
     today_str = _today_vn().strftime("%d/%m/%Y")
 
-    master_codes, name_map = _get_master_codes()
-    items_today = _get_today_messages()
-    latest = _pick_latest_per_code(items_today)
+    master_codes, name_map = _get_master_codes(chat_id)
+    # Rollup do collector duy trì: O(số mã), không đọc lại Messages (thiếu thì tự dựng lại)
+    latest = _rollup_items(_load_rollup(_today_vn(), chat_id))
     sent_codes = {it["code"] for it in latest}
 
     total = len(master_codes)
@@ -532,10 +2893,7 @@ def run_daily_report():
     for it in sorted(latest, key=lambda x: x["code"]):
         code = _html_escape(it["code"])
         name = _html_escape(name_map.get(it["code"], ""))
-        txt  = (it["text"] or "").replace("\n", " ")
-        if len(txt) > 90:
-            txt = txt[:87] + "..."
-        txt = _html_escape(txt)
+        txt  = _html_escape(_short_text(it["text"]))
         sent_lines.append(f"• ✅ <code>{code}</code> — {name} — “{txt}”")
     if not sent_lines:
         sent_lines = ["<i>Chưa có nơi nào gửi trong hôm nay</i>"]
@@ -559,17 +2917,296 @@ def run_daily_report():
     body2 = f"<b>2) Những nơi chưa gửi ({miss}):</b>\n" + "\n".join(miss_lines)
     html_msg = header + body1 + body2
 
-    _send_long_html(TELEGRAM_CHAT_ID, html_msg)
+    _send_long_html(chat_id, html_msg)
+
+# ===== Báo cáo nhiều ngày (--report --from --to): ma trận mã × ngày =====
+REPORT_MAX_DAYS = 92
+
+def _snapshot_name(day, chat_id: str | None = None) -> str:
+    return f"snapday_{_day_key(day)}{_chat_suffix(chat_id)}.json"
+
+def _day_snapshot(day, chat_id: str | None = None) -> Set[str]:
+    """Tập mã đã gửi trong 1 ngày. Ngày đã qua không còn thay đổi -> tính 1 lần rồi cache cục bộ."""
+    past = day < _today_vn()
+    name = _snapshot_name(day, chat_id)
+    if past:
+        cached = _load_json_state(name)
+        if isinstance(cached, list):
+            return set(cached)
+    codes = set(_load_rollup(day, chat_id))
+    if past:
+        _save_json_state(name, sorted(codes))
+    return codes
+
+def _zero_runs(mask: int, n: int):
+    """(chuỗi ngày thiếu dài nhất, chuỗi thiếu tính tới ngày cuối) của bitmask n ngày."""
+    longest = cur = 0
+    for i in range(n):
+        if mask >> i & 1:
+            cur = 0
+        else:
+            cur += 1
+            longest = max(longest, cur)
+    return longest, cur
+
+def _compliance(master_codes: List[str], snaps: List[Set[str]]) -> Dict[str, Dict[str, Any]]:
+    """Gộp theo cột (mỗi ngày 1 lượt): bitmask ngày đã gửi của từng mã -> tỷ lệ + chuỗi thiếu."""
+    masks = dict.fromkeys(master_codes, 0)
+    for i, codes in enumerate(snaps):
+        bit = 1 << i
+        for c in codes:
+            if c in masks:
+                masks[c] |= bit
+    n = len(snaps)
+    out = {}
+    for c, m in masks.items():
+        longest, current = _zero_runs(m, n)
+        sent = bin(m).count("1")
+        out[c] = {"mask": m, "sent": sent, "rate": sent / n if n else 0.0,
+                  "miss_streak": longest, "miss_now": current}
+    return out
+
+def run_range_report(start, end, chat_id: str | None = None):
+    chat_id = chat_id or (TELEGRAM_CHAT_IDS or [TELEGRAM_CHAT_ID])[0]
+    end = min(end, _today_vn())
+    if start > end:
+        raise SystemExit("--from must not be after --to")
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    if len(days) > REPORT_MAX_DAYS:
+        raise SystemExit(f"range too long (max {REPORT_MAX_DAYS} days)")
+
+    master_codes, name_map = _get_master_codes(chat_id)
+    snaps = [_day_snapshot(d, chat_id) for d in days]
+    stats = _compliance(master_codes, snaps)
+    n = len(days)
+
+    total = len(master_codes)
+    avg = int(round(sum(v["rate"] for v in stats.values()) / total * 100)) if total else 0
+    full = sum(1 for v in stats.values() if v["sent"] == n)
+    none = sum(1 for v in stats.values() if v["sent"] == 0)
+
+    header = (
+        f"📅 <b>Báo cáo tuân thủ</b> — {start.strftime('%d/%m/%Y')} → {end.strftime('%d/%m/%Y')} ({n} ngày)\n"
+        f"<b>Tổng quan:</b> Tổng <code>{total}</code> nơi • 📈 TB {avg}% • ✅ Đủ {n}/{n} ngày <code>{full}</code> • "
+        f"❌ Không gửi ngày nào <code>{none}</code>\n\n"
+    )
+    day_lines = []
+    for d, codes in zip(days, snaps):
+        sent = len(codes & set(master_codes))
+        day_lines.append(f"• {d.strftime('%d/%m')}: <code>{sent}/{total}</code>")
+    body1 = "<b>1) Theo ngày:</b>\n" + "\n".join(day_lines) + "\n\n"
+
+    code_lines = []
+    for c in sorted(master_codes, key=lambda c: (stats[c]["rate"], c)):
+        v = stats[c]
+        row = "".join("●" if v["mask"] >> i & 1 else "·" for i in range(n))
+        line = (f"• <code>{_html_escape(c)}</code> — {_html_escape(name_map.get(c, ''))}\n"
+                f"  <code>{row}</code> {int(round(v['rate'] * 100))}%")
+        if v["miss_streak"]:
+            line += f" • thiếu liên tiếp dài nhất {v['miss_streak']} ngày"
+            if v["miss_now"]:
+                line += f" (đang thiếu {v['miss_now']})"
+        code_lines.append(line)
+    if not code_lines:
+        code_lines = ["<i>Chưa có danh sách nơi</i>"]
+    body2 = "<b>2) Theo nơi</b> (● đã gửi · thiếu, thấp nhất trước):\n" + "\n".join(code_lines)
+
+    _send_long_html(chat_id, header + body1 + body2)
+
+# ===== Compaction (--compact) =====
+def run_compact(days: int = COMPACT_DAYS, dry_run: bool = False):
+    """Gộp UID ảnh + caption của record cũ hơn `days` ngày vào Bloom filter lịch sử,
+    ghi record đó ra ARCHIVE_DIR (jsonl.gz) rồi xoá khỏi storage (Airtable/SQLite).
+
+    Thứ tự an toàn: archive -> lưu filter (file + Meta) -> xoá; lỗi giữa chừng thì chạy lại được (key trùng
+    chỉ tốn thêm vài bit, record đã xoá không bị kéo lại)."""
+    import gzip
+    if days < REPORT_MAX_DAYS:
+        raise SystemExit(f"--compact must keep at least {REPORT_MAX_DAYS} days (used by --report)")
+    cutoff_day = _today_vn() - datetime.timedelta(days=days)
+    before = _vn_day_bounds_utc(cutoff_day)[0]
+
+    old: Dict[str, List[Dict[str, Any]]] = {TBL_MESSAGES: _table(TBL_MESSAGES).all(created_before=before)}
+    if TBL_IMAGES:
+        old[TBL_IMAGES] = _table(TBL_IMAGES).all(created_before=before)
+    keys: Set[str] = set()
+    for r in old[TBL_MESSAGES]:
+        f = r.get("fields") or {}
+        text = str(f.get(COL_MSG_TEXT, "") or "")
+        if text:
+            keys.add(_history_caption_key(str(f.get(COL_MSG_CHAT, "") or "") if COL_MSG_CHAT else "", text))
+    uids = [u for u in ((r.get("fields") or {}).get(COL_IMG_HASH) for r in old.get(TBL_IMAGES, [])) if u]
+    keys.update(f"i:{u}" for u in uids)
+    counts = ", ".join(f"{len(v)} {t}" for t, v in old.items())
+    print(f"[compact] before {cutoff_day}: {counts} row(s), {len(keys)} key(s)")
+    if dry_run or not any(old.values()):
+        return
+
+    # 1) Archive
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"compact-{_day_key(cutoff_day)}-{int(time.time())}.jsonl.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for table, recs in old.items():
+            for r in recs:
+                f.write(json.dumps({"table": table, **r}, ensure_ascii=False) + "\n")
+    print(f"[compact] archived to {path}")
+
+    # 2) Thêm 1 lớp Bloom cho phần vừa gộp (lưu trước khi xoá)
+    global _history
+    base = _history_filter()   # đồng bộ từ Meta nếu file cục bộ thiếu/cũ
+    header = _meta_get(BLOOM_META_KEY)
+    if header and (base is None or hashlib.sha256(base.to_bytes()).hexdigest() != header.rsplit(":", 1)[-1]):
+        raise SystemExit("[compact] bloom filter in Meta could not be loaded, refusing to compact")
+    hist = _BloomHistory(list(base.layers) if base else [])
+    hist.add_layer(sorted(keys))
+    hist.save(_state_path(BLOOM_FILE))
+    # Bản bền vững trong Meta là điều kiện để xoá: không lưu được thì dừng, giữ nguyên record
+    try:
+        _save_history_durable(hist)
+    except Exception as e:
+        raise SystemExit(f"[compact] could not persist the bloom filter to Meta, nothing deleted: {e}")
+    _history = hist
+    print(f"[compact] bloom filter: {len(hist.layers)} layer(s), {len(hist)} key(s)")
+
+    # 3) Xoá record cũ theo lô (giãn cách như khi ghi)
+    for table, recs in old.items():
+        tbl = _table(table)
+        for chunk in _chunks([r["id"] for r in recs], tbl.batch_size):
+            tbl.batch_delete(chunk)
+        print(f"[compact] deleted {len(recs)} {table} row(s)")
+
+    # 4) Index UID cục bộ chỉ còn giữ phần gần đây
+    if uids:
+        _open_image_index().remove(uids)
+
+# ===== Migration giữa hai backend (--migrate-to) =====
+def run_migrate(target: str, dry_run: bool = False):
+    """Chép Meta, Messages (+ Images) từ STORAGE_BACKEND hiện tại sang `target`.
+
+    Sang SQLite: giữ nguyên id + createdTime (cache STATE_DIR vẫn khớp), chạy lại an toàn.
+    Sang Airtable: id/createdTime do Airtable đặt mới -> chỉ ghi vào bảng còn trống; Messages của
+    các ngày trước (báo cáo theo createdTime) không chép mà ghi ra ARCHIVE_DIR như --compact."""
+    import gzip
+    source = STORAGE_BACKEND
+    if target not in STORAGE_BACKENDS:
+        raise SystemExit(f"--migrate-to expects one of {', '.join(STORAGE_BACKENDS)}")
+    if target == source:
+        raise SystemExit(f"STORAGE_BACKEND is already {source}")
+    today_start = _vn_day_bounds_utc(_today_vn())[0]
+    for name in [TBL_META, TBL_MESSAGES] + ([TBL_IMAGES] if TBL_IMAGES else []):
+        recs = _table(name, source).all()
+        dst = _table(name, target)
+        if target == "sqlite":
+            print(f"[migrate] {name}: {len(recs)} row(s) {source} -> {target}")
+            if not dry_run:
+                _get_sqlite_store().insert(name, recs)
+            continue
+        if dst.all():
+            print(f"[migrate] {name}: {target} table is not empty, skipped")
+            continue
+        old = [r for r in recs if name == TBL_MESSAGES and r["createdTime"] < today_start]
+        recs = [r for r in recs if not (name == TBL_MESSAGES and r["createdTime"] < today_start)]
+        print(f"[migrate] {name}: {len(recs)} row(s) {source} -> {target}"
+              + (f", {len(old)} older row(s) to archive" if old else ""))
+        if dry_run:
+            continue
+        if old:
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            path = os.path.join(ARCHIVE_DIR, f"migrate-{name}-{int(time.time())}.jsonl.gz")
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                for r in old:
+                    f.write(json.dumps({"table": name, **r}, ensure_ascii=False) + "\n")
+            print(f"[migrate] archived to {path}")
+        for chunk in _chunks([r["fields"] for r in recs], dst.batch_size):
+            dst.batch_create(chunk)
+    if target == "airtable" and not dry_run:
+        # Cache Messages hôm nay giữ id cũ của SQLite -> bỏ để lần chạy sau kéo lại từ Airtable
+        with contextlib.suppress(OSError):
+            os.remove(_state_path(_msgday_state_name(_today_vn())))
 
 # ===== Main =====
+def _main(args):
+    if args.rebuild_images or args.verify_images:
+        if not TBL_IMAGES:
+            raise SystemExit("TBL_IMAGES is not configured")
+        idx = _open_image_index()
+        if args.rebuild_images:
+            print(f"[images] rebuilt index: {idx.rebuild()} records")
+        if args.verify_images:
+            res = idx.verify()
+            print(f"[images] verify: {json.dumps(res)}")
+            if res["missing_local"] or res["extra_local"]:
+                raise SystemExit(1)
+    elif args.replay:
+        run_replay(args.replay, send_replies=args.replies, restart=args.restart)
+    elif args.migrate_to:
+        run_migrate(args.migrate_to, dry_run=args.dry_run)
+    elif args.compact:
+        run_compact(args.days if args.days is not None else COMPACT_DAYS, dry_run=args.dry_run)
+    elif args.rebuild_rollup:
+        day = datetime.date.fromisoformat(args.date) if args.date else _today_vn()
+        buf = _WriteBuffer()
+        for chat_id in TELEGRAM_CHAT_IDS or [TELEGRAM_CHAT_ID]:
+            roll = _rollup_from_messages(day, chat_id)
+            _save_rollup(day, roll, buf, chat_id)
+            print(f"[rollup] {day} chat {chat_id}: {len(roll)} code(s)")
+        buf.flush()
+    elif args.report:
+        if not args.date_from:
+            raise SystemExit("--report needs --from YYYY-MM-DD")
+        start = datetime.date.fromisoformat(args.date_from)
+        end = datetime.date.fromisoformat(args.date_to) if args.date_to else _today_vn()
+        for chat_id in _report_chats():
+            run_range_report(start, end, chat_id)
+    elif args.daily:
+        for chat_id in _report_chats():
+            run_daily_report(chat_id)
+    elif args.serve:
+        serve_forever()
+    elif args.webhook:
+        run_webhook()
+    else:
+        collect_once()
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--collect", action="store_true", help="Poll Telegram & record messages")
     parser.add_argument("--daily", action="store_true", help="Send 21h report")
+    parser.add_argument("--serve", action="store_true", help="Run continuously, long-polling getUpdates")
+    parser.add_argument("--webhook", action="store_true", help="Run a local HTTP server for Telegram webhook updates")
+    parser.add_argument("--rebuild-images", action="store_true", help="Rebuild local Images UID index from Airtable")
+    parser.add_argument("--verify-images", action="store_true", help="Compare local Images UID index with Airtable")
+    parser.add_argument("--rebuild-rollup", action="store_true", help="Rebuild the daily rollup from Messages")
+    parser.add_argument("--date", help="Day for --rebuild-rollup (YYYY-MM-DD, VN time; default today)")
+    parser.add_argument("--report", action="store_true", help="Send multi-day compliance report (--from/--to)")
+    parser.add_argument("--from", dest="date_from", help="First day for --report (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", help="Last day for --report (YYYY-MM-DD; default today)")
+    parser.add_argument("--replay", metavar="FILE", help="Ingest Telegram updates from a JSONL file")
+    parser.add_argument("--replies", action="store_true", help="With --replay: send replies (default: suppressed)")
+    parser.add_argument("--restart", action="store_true", help="With --replay: ignore the saved checkpoint")
+    parser.add_argument("--compact", action="store_true",
+                        help="Fold old Images/Messages rows into the Bloom history, archive and delete them")
+    parser.add_argument("--days", type=int, help="Days of history kept by --compact (default COMPACT_DAYS)")
+    parser.add_argument("--dry-run", action="store_true", help="With --compact/--migrate-to: only count the rows")
+    parser.add_argument("--migrate-to", choices=STORAGE_BACKENDS,
+                        help="Copy Meta/Messages/Images from STORAGE_BACKEND to the other backend")
+    parser.add_argument("--profile", nargs="?", const="bot.prof", metavar="FILE",
+                        help="Dump a cProfile of the run (default bot.prof)")
     args = parser.parse_args()
 
-    if args.daily:
-        run_daily_report()
-    else:
-        collect_once()
+    run = next((m for m in ("rebuild_images", "verify_images", "replay", "migrate_to", "compact", "rebuild_rollup", "report", "daily",
+                            "serve", "webhook") if getattr(args, m)), "collect")
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        _main(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"[profile] wrote {args.profile}")
+        _metrics.emit(run)
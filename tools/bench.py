@@ -0,0 +1,207 @@
+# bench.py — benchmark collect_once / run_daily_report với Telegram + Airtable giả lập (tools/fakes.py)
+# - Kịch bản: idle (không có update), collect (cache trống), collect-warm (đã có cache), report
+# - Workload tổng hợp: N update, M album (3 ảnh), K record có sẵn trong Messages/Images, độ trễ mỗi request
+# - Đo: wall time, số lần gọi API theo endpoint, peak memory (tracemalloc), record/giây
+# - Mỗi kịch bản chạy trong 1 process con riêng (bot đọc ENV + giữ cache ở cấp module)
+# - Lưu baseline JSON và so sánh: số lần gọi API tăng hoặc thời gian/bộ nhớ vượt ngưỡng -> exit 1
+# Ví dụ:
+#   python tools/bench.py --save-baseline tools/bench_baseline.json
+#   python tools/bench.py --compare tools/bench_baseline.json
+
+import argparse, datetime, json, os, subprocess, sys, tempfile, time, tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SCENARIOS = ("idle", "collect", "collect-warm", "report")
+CHAT_ID = -1000000000001
+TIME_SLACK_S = 0.1      # bỏ qua chênh lệch thời gian tuyệt đối nhỏ (kịch bản chạy vài ms)
+
+
+# ===== Workload =====
+def _codes(n: int):
+    return [f"{10000000 + i:08d}" for i in range(n)]
+
+def _make_updates(n: int, albums: int, codes):
+    """n update: các album (1 caption + 2 ảnh) trước, còn lại là ảnh lẻ; ~10% ảnh gửi lại."""
+    out, uid, mid = [], 1, 1
+    now = int(time.time())
+
+    def add(msg):
+        nonlocal uid, mid
+        msg.update({"message_id": mid, "chat": {"id": CHAT_ID}, "from": {"id": 7, "is_bot": False}, "date": now})
+        out.append({"update_id": uid, "message": msg})
+        uid += 1
+        mid += 1
+
+    for a in range(albums):
+        if len(out) + 3 > n:
+            break
+        code = codes[a % len(codes)]
+        add({"caption": f"{code} - album {a}", "photo": [{"file_id": f"al{a}p0", "file_unique_id": f"al{a}p0"}],
+             "media_group_id": f"mg{a}"})
+        for k in (1, 2):
+            add({"photo": [{"file_id": f"al{a}p{k}", "file_unique_id": f"al{a}p{k}"}], "media_group_id": f"mg{a}"})
+    i = 0
+    while len(out) < n:
+        code = codes[i % len(codes)]
+        ph = f"s{i // 10 * 10}" if i % 10 == 9 else f"s{i}"   # mỗi 10 ảnh có 1 ảnh trùng
+        add({"caption": f"{code} - report {i}", "photo": [{"file_id": ph, "file_unique_id": ph}]})
+        i += 1
+    return out
+
+def _created_list(rows: int):
+    """createdTime cách nhau 10ms, kết thúc trước hiện tại (watermark không trùng -> số lần gọi ổn định)."""
+    end = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+    return [(end - datetime.timedelta(milliseconds=10 * (rows - i))).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+            for i in range(rows)]
+
+def _seed(fs, codes, rows: int):
+    fs.at.seed("Meta", [{"MaNoi": c, "TenNoi": f"Noi {c}"} for c in codes])
+    fs.at.seed("Messages", [{"TextOrCaption": f"{codes[i % len(codes)]} - old {i}", "Code": codes[i % len(codes)]}
+                            for i in range(rows)], created=_created_list(rows))
+    fs.at.seed("Images", [{"FileUniqueId": f"old{i}", "Code": codes[i % len(codes)], "Date": "2024-01-01"}
+                          for i in range(rows)], created=_created_list(rows))
+
+
+# ===== Process con: chạy 1 kịch bản =====
+def _child(args):
+    sys.path.insert(0, HERE)
+    from fakes import FakeServers
+
+    with FakeServers(args.latency) as fs:
+        os.environ.update({
+            "TELEGRAM_BOT_TOKEN": "BENCH", "TELEGRAM_CHAT_ID": str(CHAT_ID),
+            "AIRTABLE_TOKEN": "bench", "AIRTABLE_BASE_ID": "appBench", "TBL_IMAGES": "Images",
+            "TELEGRAM_API_BASE": fs.url, "AIRTABLE_ENDPOINT_URL": fs.url,
+            "STATE_DIR": tempfile.mkdtemp(prefix="bench-state-"),
+            "AIRTABLE_RPS": str(args.airtable_rps), "REPLY_PER_CHAT_MIN": "1000000",
+        })
+        sys.path.insert(0, ROOT)
+        t0 = time.perf_counter()
+        import bot
+        import_s = time.perf_counter() - t0
+
+        codes = _codes(args.codes)
+        _seed(fs, codes, args.rows)
+        updates = _make_updates(args.updates, args.albums, codes)
+        if args.scenario == "collect-warm":
+            # lần chạy trước đã điền cache .state/ (index ảnh, tin nhắn trong ngày); chỉ đo lần sau
+            fs.tg.push(updates[: len(updates) // 2])
+            bot.collect_once()
+            updates = updates[len(updates) // 2:]
+            fs.tg.calls.clear()
+            fs.at.calls.clear()
+        if args.scenario == "idle":
+            # phần lớn các lần cron: hàng đợi Telegram rỗng
+            updates = []
+        if args.scenario == "report":
+            # báo cáo đọc các record đã có trong ngày (Messages do collector ghi)
+            fs.tg.push(updates)
+            bot.collect_once()
+            fs.tg.calls.clear()
+            fs.at.calls.clear()
+            records = len(fs.at.tables["Messages"])
+            run = bot.run_daily_report
+        else:
+            fs.tg.push(updates)
+            records = len(updates)
+            run = bot.collect_once
+
+        if args.scenario != "idle":
+            # import pyairtable (lazy trong bot) trước khi đo bộ nhớ của phần xử lý; idle đo đúng
+            # phần cron rảnh phải trả (không được nạp pyairtable)
+            bot._get_api()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        run()
+        wall = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        calls = fs.calls()
+
+    print(json.dumps({
+        "scenario": args.scenario, "wall_s": round(wall, 4), "import_s": round(import_s, 4), "records": records,
+        "records_per_s": round(records / wall, 1) if wall else None,
+        "peak_mem_kb": peak // 1024, "calls": calls,
+    }))
+
+
+def _run_scenario(name: str, args) -> dict:
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", "--scenario", name,
+           "--updates", str(args.updates), "--albums", str(args.albums), "--rows", str(args.rows),
+           "--codes", str(args.codes), "--latency", str(args.latency), "--airtable-rps", str(args.airtable_rps)]
+    p = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout)
+    if p.returncode != 0:
+        sys.stderr.write(p.stdout + p.stderr)
+        raise SystemExit(f"[bench] scenario {name} failed")
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+# ===== So sánh baseline =====
+def _compare(results: dict, baseline: dict, time_tol: float, mem_tol: float) -> list:
+    problems = []
+    if baseline.get("params") != results["params"]:
+        problems.append(f"params differ from baseline: {baseline.get('params')} != {results['params']}")
+        return problems
+    for name, cur in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if not base:
+            continue
+        for ep, n in cur["calls"].items():
+            if n > base["calls"].get(ep, 0):
+                problems.append(f"{name}: {ep} calls {base['calls'].get(ep, 0)} -> {n}")
+        if cur["wall_s"] > base["wall_s"] * (1 + time_tol) + TIME_SLACK_S:
+            problems.append(f"{name}: wall {base['wall_s']}s -> {cur['wall_s']}s")
+        if cur["peak_mem_kb"] > base["peak_mem_kb"] * (1 + mem_tol):
+            problems.append(f"{name}: peak memory {base['peak_mem_kb']}KB -> {cur['peak_mem_kb']}KB")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenario", choices=SCENARIOS, action="append", help="Default: all scenarios")
+    ap.add_argument("--updates", type=int, default=300, help="N updates in getUpdates")
+    ap.add_argument("--albums", type=int, default=20, help="M albums (3 parts each) among the updates")
+    ap.add_argument("--rows", type=int, default=2000, help="K existing rows in Messages and Images")
+    ap.add_argument("--codes", type=int, default=50, help="Master codes in Meta")
+    ap.add_argument("--latency", type=float, default=0.0, help="Seconds added to every fake API request")
+    ap.add_argument("--airtable-rps", type=float, default=1000.0, help="AIRTABLE_RPS for the run (5 = production)")
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--save-baseline", metavar="FILE")
+    ap.add_argument("--compare", metavar="FILE")
+    ap.add_argument("--time-tolerance", type=float, default=0.5, help="Allowed wall time growth vs baseline")
+    ap.add_argument("--mem-tolerance", type=float, default=0.25, help="Allowed peak memory growth vs baseline")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        args.scenario = args.scenario[0]
+        return _child(args)
+
+    params = {k: getattr(args, k) for k in ("updates", "albums", "rows", "codes", "latency", "airtable_rps")}
+    results = {"params": params, "scenarios": {}}
+    for name in args.scenario or SCENARIOS:
+        r = _run_scenario(name, args)
+        results["scenarios"][name] = r
+        calls = ", ".join(f"{k}={v}" for k, v in r["calls"].items())
+        print(f"[bench] {name:<13} {r['wall_s']:8.3f}s {r['records_per_s'] or 0:9.1f} rec/s "
+              f"{r['peak_mem_kb']:7d}KB  {calls}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"[bench] baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = _compare(results, baseline, args.time_tolerance, args.mem_tolerance)
+        for p in problems:
+            print(f"[bench] REGRESSION {p}")
+        if problems:
+            sys.exit(1)
+        print("[bench] no regression vs baseline")
+
+
+if __name__ == "__main__":
+    main()
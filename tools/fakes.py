@@ -0,0 +1,263 @@
+# fakes.py — server giả lập Telegram Bot API + Airtable REST API chạy local (dùng cho tools/bench.py)
+# - Telegram: getUpdates (offset/limit), sendMessage, getFile, setWebhook, tải file; đếm số lần gọi mỗi method
+# - Airtable: list (filterByFormula, fields[], phân trang), create/batch_create, update/batch_update, batch_delete
+# - Độ trễ giả lập cấu hình được (giây / request); trỏ bot vào đây bằng TELEGRAM_API_BASE / AIRTABLE_ENDPOINT_URL
+
+import json, re, threading, time, datetime, itertools, collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+PAGE_SIZE = 100
+
+
+def _now_ts() -> str:
+    u = datetime.datetime.now(datetime.timezone.utc)
+    return u.strftime("%Y-%m-%dT%H:%M:%S.") + f"{u.microsecond // 1000:03d}Z"
+
+
+# ===== Formula (tập con đủ cho các công thức bot.py sinh ra) =====
+def _to_dt(v):
+    if isinstance(v, datetime.datetime):
+        return v
+    return datetime.datetime.fromisoformat(str(v).replace("Z", "+00:00"))
+
+def _formula_env(rec):
+    fields = rec["fields"]
+    return {
+        "CREATED_TIME": lambda: _to_dt(rec["createdTime"]),
+        "DATETIME_PARSE": lambda s, *a: _to_dt(s),
+        "IS_BEFORE": lambda a, b: _to_dt(a) < _to_dt(b),
+        "IS_AFTER": lambda a, b: _to_dt(a) > _to_dt(b),
+        "AND": lambda *a: all(a),
+        "OR": lambda *a: any(a),
+        "NOT": lambda a: not a,
+        "LOWER": lambda s: str(s).lower(),
+        "LEFT": lambda s, n: str(s)[:int(n)],
+        "TO_TEXT": lambda s: "" if s is None else str(s),
+        "RECORD_ID": lambda: rec["id"],
+        "BLANK": lambda: None,
+        "_f": lambda name: fields.get(name),
+    }
+
+def compile_formula(formula: str):
+    expr = re.sub(r"\{([^}]*)\}", lambda m: f"_f({m.group(1)!r})", formula)
+    expr = re.sub(r"(?<![<>!=])=(?!=)", "==", expr)
+    expr = expr.replace("&", "+")
+    code = compile(expr, "<formula>", "eval")
+    return lambda rec: bool(eval(code, _formula_env(rec)))
+
+
+# ===== Airtable =====
+class FakeAirtable:
+    def __init__(self):
+        self.tables = collections.defaultdict(dict)   # table -> {id: record}
+        self.calls = collections.Counter()
+        self._ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def new_id(self) -> str:
+        return f"rec{next(self._ids):014d}"
+
+    def seed(self, table: str, fields_list, created=None):
+        """Thêm record có sẵn; created: 1 timestamp chung hoặc list timestamp theo từng record."""
+        with self.lock:
+            for i, fields in enumerate(fields_list):
+                rid = self.new_id()
+                ts = created[i] if isinstance(created, list) else created
+                self.tables[table][rid] = {"id": rid, "createdTime": ts or _now_ts(), "fields": dict(fields)}
+
+    def list(self, table, formula=None, fields=None, offset=0, page_size=PAGE_SIZE):
+        recs = list(self.tables[table].values())
+        if formula:
+            pred = compile_formula(formula)
+            recs = [r for r in recs if pred(r)]
+        page = recs[offset:offset + page_size]
+        out = []
+        for r in page:
+            f = r["fields"] if not fields else {k: v for k, v in r["fields"].items() if k in fields}
+            out.append({"id": r["id"], "createdTime": r["createdTime"], "fields": f})
+        nxt = offset + page_size if offset + page_size < len(recs) else None
+        return out, nxt
+
+    def create(self, table, fields):
+        rid = self.new_id()
+        rec = {"id": rid, "createdTime": _now_ts(), "fields": dict(fields)}
+        self.tables[table][rid] = rec
+        return rec
+
+    def update(self, table, rid, fields):
+        rec = self.tables[table].get(rid)
+        if rec is None:
+            return None
+        rec["fields"].update(fields)
+        return rec
+
+
+# ===== Telegram =====
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []           # danh sách update chưa xác nhận (sắp theo update_id)
+        self.sent = []              # các sendMessage đã nhận
+        self.calls = collections.Counter()
+        self.files = {}             # file_id -> bytes
+        self.lock = threading.Lock()
+        self._msg_ids = itertools.count(10_000_000)
+        self.faults = []            # [(status, body)] trả về cho các request kế tiếp (mô phỏng 429/5xx)
+
+    def push(self, updates):
+        with self.lock:
+            self.updates.extend(updates)
+            self.updates.sort(key=lambda u: u["update_id"])
+
+    def get_updates(self, offset=None, limit=100):
+        with self.lock:
+            if offset is not None:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            return list(self.updates[:max(1, min(int(limit or 100), 100))])
+
+
+def _make_handler(tg: FakeTelegram, at: FakeAirtable, latency: float):
+    class H(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True   # header + body gửi 2 lần write: tránh trễ ~40ms do Nagle/delayed ACK
+
+        def log_message(self, *a):
+            pass
+
+        def _body(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(n) if n else b""
+            return json.loads(raw) if raw else {}
+
+        def _send(self, obj, status=200, raw: bytes = None):
+            data = raw if raw is not None else json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json" if raw is None else "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _route(self, method):
+            if latency:
+                time.sleep(latency)
+            u = urlparse(self.path)
+            parts = [unquote(p) for p in u.path.split("/") if p]
+            if parts and parts[0].startswith("bot"):
+                return self._telegram(parts[1] if len(parts) > 1 else "")
+            if len(parts) >= 2 and parts[0] == "file":
+                tg.calls["file"] += 1
+                data = tg.files.get("/".join(parts[2:]))
+                return self._send(None, 200 if data else 404, raw=data or b"")
+            if len(parts) >= 3 and parts[0] == "v0":
+                return self._airtable(method, parts[2:], parse_qs(u.query))
+            self._send({"error": "not found"}, 404)
+
+        # ---- Telegram ----
+        def _telegram(self, tmethod):
+            body = self._body()
+            tg.calls[tmethod] += 1
+            with tg.lock:
+                fault = tg.faults.pop(0) if tg.faults else None
+            if fault:
+                return self._send(fault[1], fault[0])
+            if tmethod == "getUpdates":
+                return self._send({"ok": True, "result": tg.get_updates(body.get("offset"), body.get("limit", 100))})
+            if tmethod == "sendMessage":
+                with tg.lock:
+                    mid = next(tg._msg_ids)
+                    tg.sent.append(body)
+                return self._send({"ok": True, "result": {"message_id": mid, "chat": {"id": body.get("chat_id")},
+                                                          "text": body.get("text")}})
+            if tmethod == "getFile":
+                fid = body.get("file_id")
+                return self._send({"ok": True, "result": {"file_id": fid, "file_path": fid}})
+            if tmethod == "getMe":
+                return self._send({"ok": True, "result": {"id": 1, "is_bot": True, "username": "FakeBot"}})
+            if tmethod in ("setWebhook", "deleteWebhook"):
+                return self._send({"ok": True, "result": True})
+            return self._send({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+
+        # ---- Airtable ----
+        def _airtable(self, method, rest, q):
+            table = rest[0]
+            list_post = len(rest) > 1 and rest[1] == "listRecords"
+            rid = rest[1] if len(rest) > 1 and not list_post else None
+            body = self._body() if method in ("POST", "PATCH", "PUT") else {}
+            at.calls[f"{method} {table}"] += 1
+            with at.lock:
+                if method == "GET" or list_post:
+                    src = body if list_post else {k: (v if k.endswith("[]") else v[0]) for k, v in q.items()}
+                    formula = src.get("filterByFormula")
+                    fields = src.get("fields") or src.get("fields[]")
+                    off = int(src.get("offset") or 0)
+                    size = int(src.get("pageSize") or PAGE_SIZE)
+                    recs, nxt = at.list(table, formula, fields, off, size)
+                    out = {"records": recs}
+                    if nxt is not None:
+                        out["offset"] = str(nxt)
+                    return self._send(out)
+                if method == "POST":
+                    if "records" in body:
+                        return self._send({"records": [at.create(table, r["fields"]) for r in body["records"]]})
+                    return self._send(at.create(table, body.get("fields") or {}))
+                if method in ("PATCH", "PUT"):
+                    if rid:
+                        rec = at.update(table, rid, body.get("fields") or {})
+                        return self._send(rec or {"error": "NOT_FOUND"}, 200 if rec else 404)
+                    out = []
+                    for r in body.get("records", []):
+                        rec = at.update(table, r["id"], r.get("fields") or {})
+                        if rec is None:
+                            return self._send({"error": {"type": "ROW_DOES_NOT_EXIST"}}, 422)
+                        out.append(rec)
+                    return self._send({"records": out})
+                if method == "DELETE":
+                    ids = [rid] if rid else q.get("records[]", [])
+                    for i in ids:
+                        at.tables[table].pop(i, None)
+                    if rid:
+                        return self._send({"id": rid, "deleted": True})
+                    return self._send({"records": [{"id": i, "deleted": True} for i in ids]})
+            self._send({"error": "bad request"}, 400)
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+        def do_PATCH(self):
+            self._route("PATCH")
+
+        def do_PUT(self):
+            self._route("PUT")
+
+        def do_DELETE(self):
+            self._route("DELETE")
+
+    return H
+
+
+class FakeServers:
+    """Chạy Telegram + Airtable giả trên cùng một cổng local (thread nền)."""
+
+    def __init__(self, latency: float = 0.0):
+        self.tg = FakeTelegram()
+        self.at = FakeAirtable()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self.tg, self.at, latency))
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._t = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._t.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def calls(self):
+        out = {f"telegram {k}": v for k, v in self.tg.calls.items()}
+        out.update({f"airtable {k}": v for k, v in self.at.calls.items()})
+        return dict(sorted(out.items()))
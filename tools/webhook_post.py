@@ -0,0 +1,52 @@
+# webhook_post.py — client giả lập Telegram: POST các update (JSONL) tới server --webhook
+# - Mỗi dòng của file là một object update như Telegram gửi
+# - Gửi kèm header X-Telegram-Bot-Api-Secret-Token; 503 thì gửi lại sau (giống Telegram)
+# Ví dụ: python tools/webhook_post.py updates.jsonl --url http://127.0.0.1:8080/telegram-webhook --secret S
+
+import argparse, json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def post_update(session: requests.Session, url: str, secret: str, update: dict,
+                retries: int = 20, backoff: float = 0.5) -> int:
+    """POST một update; 503/lỗi kết nối thì thử lại. Trả về HTTP status cuối cùng."""
+    status = 0
+    for attempt in range(retries):
+        try:
+            r = session.post(url, json=update, timeout=10,
+                             headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+            status = r.status_code
+            if status != 503:
+                return status
+        except requests.ConnectionError:
+            status = 0
+        time.sleep(min(backoff * (2 ** attempt), 5.0))
+    return status
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("file", help="JSONL file, one Telegram update per line ('-' = stdin)")
+    ap.add_argument("--url", default=os.getenv("WEBHOOK_POST_URL", "http://127.0.0.1:8080/telegram-webhook"))
+    ap.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    ap.add_argument("--concurrency", type=int, default=4)
+    args = ap.parse_args()
+
+    src = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+    updates = [json.loads(line) for line in src if line.strip()]
+
+    session = requests.Session()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        statuses = list(pool.map(lambda u: post_update(session, args.url, args.secret, u), updates))
+    dt = time.perf_counter() - t0
+
+    bad = [s for s in statuses if s != 200]
+    print(f"[webhook_post] sent {len(updates)} update(s) in {dt:.2f}s, {len(bad)} not accepted")
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()